@@ -0,0 +1,98 @@
+# Generated by python -m lotina band-tables. Do not edit.
+# fmt: off
+
+WINDOW = (
+    0, 1, 5, 11, 20, 31, 44, 60, 79, 100, 123, 149,
+    177, 208, 241, 277, 315, 355, 398, 443, 491, 541, 593, 648,
+    705, 765, 827, 891, 958, 1027, 1098, 1171, 1247, 1325, 1406, 1488,
+    1573, 1660, 1749, 1841, 1935, 2030, 2128, 2229, 2331, 2435, 2542, 2650,
+    2761, 2874, 2989, 3105, 3224, 3345, 3468, 3592, 3719, 3847, 3978, 4110,
+    4244, 4380, 4518, 4657, 4799, 4942, 5086, 5233, 5381, 5531, 5682, 5835,
+    5990, 6146, 6304, 6463, 6624, 6786, 6950, 7115, 7281, 7449, 7618, 7789,
+    7961, 8134, 8308, 8484, 8660, 8838, 9017, 9197, 9379, 9561, 9744, 9929,
+    10114, 10300, 10487, 10675, 10864, 11054, 11244, 11436, 11628, 11820, 12014, 12208,
+    12403, 12598, 12794, 12990, 13187, 13385, 13583, 13781, 13980, 14179, 14378, 14578,
+    14778, 14978, 15178, 15379, 15580, 15780, 15981, 16182, 16383, 16585, 16786, 16987,
+    17187, 17388, 17589, 17789, 17989, 18189, 18389, 18588, 18787, 18986, 19184, 19382,
+    19580, 19777, 19973, 20169, 20364, 20559, 20753, 20947, 21139, 21331, 21523, 21713,
+    21903, 22092, 22280, 22467, 22653, 22838, 23023, 23206, 23388, 23570, 23750, 23929,
+    24107, 24283, 24459, 24633, 24806, 24978, 25149, 25318, 25486, 25652, 25817, 25981,
+    26143, 26304, 26463, 26621, 26777, 26932, 27085, 27236, 27386, 27534, 27681, 27825,
+    27968, 28110, 28249, 28387, 28523, 28657, 28789, 28920, 29048, 29175, 29299, 29422,
+    29543, 29662, 29778, 29893, 30006, 30117, 30225, 30332, 30436, 30538, 30639, 30737,
+    30832, 30926, 31018, 31107, 31194, 31279, 31361, 31442, 31520, 31596, 31669, 31740,
+    31809, 31876, 31940, 32002, 32062, 32119, 32174, 32226, 32276, 32324, 32369, 32412,
+    32452, 32490, 32526, 32559, 32590, 32618, 32644, 32667, 32688, 32707, 32723, 32736,
+    32747, 32756, 32762, 32766, 32767, 32766, 32762, 32756, 32747, 32736, 32723, 32707,
+    32688, 32667, 32644, 32618, 32590, 32559, 32526, 32490, 32452, 32412, 32369, 32324,
+    32276, 32226, 32174, 32119, 32062, 32002, 31940, 31876, 31809, 31740, 31669, 31596,
+    31520, 31442, 31361, 31279, 31194, 31107, 31018, 30926, 30832, 30737, 30639, 30538,
+    30436, 30332, 30225, 30117, 30006, 29893, 29778, 29662, 29543, 29422, 29299, 29175,
+    29048, 28920, 28789, 28657, 28523, 28387, 28249, 28110, 27968, 27825, 27681, 27534,
+    27386, 27236, 27085, 26932, 26777, 26621, 26463, 26304, 26143, 25981, 25817, 25652,
+    25486, 25318, 25149, 24978, 24806, 24633, 24459, 24283, 24107, 23929, 23750, 23570,
+    23388, 23206, 23023, 22838, 22653, 22467, 22280, 22092, 21903, 21713, 21523, 21331,
+    21139, 20947, 20753, 20559, 20364, 20169, 19973, 19777, 19580, 19382, 19184, 18986,
+    18787, 18588, 18389, 18189, 17989, 17789, 17589, 17388, 17187, 16987, 16786, 16585,
+    16384, 16182, 15981, 15780, 15580, 15379, 15178, 14978, 14778, 14578, 14378, 14179,
+    13980, 13781, 13583, 13385, 13187, 12990, 12794, 12598, 12403, 12208, 12014, 11820,
+    11628, 11436, 11244, 11054, 10864, 10675, 10487, 10300, 10114, 9929, 9744, 9561,
+    9379, 9197, 9017, 8838, 8660, 8484, 8308, 8134, 7961, 7789, 7618, 7449,
+    7281, 7115, 6950, 6786, 6624, 6463, 6304, 6146, 5990, 5835, 5682, 5531,
+    5381, 5233, 5086, 4942, 4799, 4657, 4518, 4380, 4244, 4110, 3978, 3847,
+    3719, 3592, 3468, 3345, 3224, 3105, 2989, 2874, 2761, 2650, 2542, 2435,
+    2331, 2229, 2128, 2030, 1935, 1841, 1749, 1660, 1573, 1488, 1406, 1325,
+    1247, 1171, 1098, 1027, 958, 891, 827, 765, 705, 648, 593, 541,
+    491, 443, 398, 355, 315, 277, 241, 208, 177, 149, 123, 100,
+    79, 60, 44, 31, 20, 11, 5, 1,
+)
+
+TWIDDLES_COS = (
+    32767, 32765, 32757, 32745, 32728, 32705, 32678, 32646, 32609, 32567, 32521, 32469,
+    32412, 32351, 32285, 32213, 32137, 32057, 31971, 31880, 31785, 31685, 31580, 31470,
+    31356, 31237, 31113, 30985, 30852, 30714, 30571, 30424, 30273, 30117, 29956, 29791,
+    29621, 29447, 29268, 29085, 28898, 28706, 28510, 28310, 28105, 27896, 27683, 27466,
+    27245, 27019, 26790, 26556, 26319, 26077, 25832, 25582, 25329, 25072, 24811, 24547,
+    24279, 24007, 23731, 23452, 23170, 22884, 22594, 22301, 22005, 21705, 21403, 21096,
+    20787, 20475, 20159, 19841, 19519, 19195, 18868, 18537, 18204, 17869, 17530, 17189,
+    16846, 16499, 16151, 15800, 15446, 15090, 14732, 14372, 14010, 13645, 13279, 12910,
+    12539, 12167, 11793, 11417, 11039, 10659, 10278, 9896, 9512, 9126, 8739, 8351,
+    7962, 7571, 7179, 6786, 6393, 5998, 5602, 5205, 4808, 4410, 4011, 3612,
+    3212, 2811, 2410, 2009, 1608, 1206, 804, 402, 0, -402, -804, -1206,
+    -1608, -2009, -2410, -2811, -3212, -3612, -4011, -4410, -4808, -5205, -5602, -5998,
+    -6393, -6786, -7179, -7571, -7962, -8351, -8739, -9126, -9512, -9896, -10278, -10659,
+    -11039, -11417, -11793, -12167, -12539, -12910, -13279, -13645, -14010, -14372, -14732, -15090,
+    -15446, -15800, -16151, -16499, -16846, -17189, -17530, -17869, -18204, -18537, -18868, -19195,
+    -19519, -19841, -20159, -20475, -20787, -21096, -21403, -21705, -22005, -22301, -22594, -22884,
+    -23170, -23452, -23731, -24007, -24279, -24547, -24811, -25072, -25329, -25582, -25832, -26077,
+    -26319, -26556, -26790, -27019, -27245, -27466, -27683, -27896, -28105, -28310, -28510, -28706,
+    -28898, -29085, -29268, -29447, -29621, -29791, -29956, -30117, -30273, -30424, -30571, -30714,
+    -30852, -30985, -31113, -31237, -31356, -31470, -31580, -31685, -31785, -31880, -31971, -32057,
+    -32137, -32213, -32285, -32351, -32412, -32469, -32521, -32567, -32609, -32646, -32678, -32705,
+    -32728, -32745, -32757, -32765,
+)
+
+TWIDDLES_SIN = (
+    0, 402, 804, 1206, 1608, 2009, 2410, 2811, 3212, 3612, 4011, 4410,
+    4808, 5205, 5602, 5998, 6393, 6786, 7179, 7571, 7962, 8351, 8739, 9126,
+    9512, 9896, 10278, 10659, 11039, 11417, 11793, 12167, 12539, 12910, 13279, 13645,
+    14010, 14372, 14732, 15090, 15446, 15800, 16151, 16499, 16846, 17189, 17530, 17869,
+    18204, 18537, 18868, 19195, 19519, 19841, 20159, 20475, 20787, 21096, 21403, 21705,
+    22005, 22301, 22594, 22884, 23170, 23452, 23731, 24007, 24279, 24547, 24811, 25072,
+    25329, 25582, 25832, 26077, 26319, 26556, 26790, 27019, 27245, 27466, 27683, 27896,
+    28105, 28310, 28510, 28706, 28898, 29085, 29268, 29447, 29621, 29791, 29956, 30117,
+    30273, 30424, 30571, 30714, 30852, 30985, 31113, 31237, 31356, 31470, 31580, 31685,
+    31785, 31880, 31971, 32057, 32137, 32213, 32285, 32351, 32412, 32469, 32521, 32567,
+    32609, 32646, 32678, 32705, 32728, 32745, 32757, 32765, 32767, 32765, 32757, 32745,
+    32728, 32705, 32678, 32646, 32609, 32567, 32521, 32469, 32412, 32351, 32285, 32213,
+    32137, 32057, 31971, 31880, 31785, 31685, 31580, 31470, 31356, 31237, 31113, 30985,
+    30852, 30714, 30571, 30424, 30273, 30117, 29956, 29791, 29621, 29447, 29268, 29085,
+    28898, 28706, 28510, 28310, 28105, 27896, 27683, 27466, 27245, 27019, 26790, 26556,
+    26319, 26077, 25832, 25582, 25329, 25072, 24811, 24547, 24279, 24007, 23731, 23452,
+    23170, 22884, 22594, 22301, 22005, 21705, 21403, 21096, 20787, 20475, 20159, 19841,
+    19519, 19195, 18868, 18537, 18204, 17869, 17530, 17189, 16846, 16499, 16151, 15800,
+    15446, 15090, 14732, 14372, 14010, 13645, 13279, 12910, 12539, 12167, 11793, 11417,
+    11039, 10659, 10278, 9896, 9512, 9126, 8739, 8351, 7962, 7571, 7179, 6786,
+    6393, 5998, 5602, 5205, 4808, 4410, 4011, 3612, 3212, 2811, 2410, 2009,
+    1608, 1206, 804, 402,
+)
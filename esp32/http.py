@@ -6,6 +6,12 @@
 import re
 import socket
 
+SOCKET_TIMEOUT_S = 10
+
+# Resolved addresses and idle keep-alive connections, keyed by (hostname, port)
+_addresses = {}
+_idle_connections = {}
+
 
 def _parse_url(url):
     m = re.match(r"^http://([a-zA-Z0-9_-\.]+(:[0-9]+)?)(/?|(/[a-zA-Z0-9_-\.]+)*)$", url)
@@ -23,40 +29,170 @@ def _parse_host(host):
     return hostname, port
 
 
-def _initiate_get_request(sock, host, path, accept):
+def _get_address(key):
+    address = _addresses.get(key)
+    if address is None:
+        address = socket.getaddrinfo(*key)[0][-1]
+        _addresses[key] = address
+    return address
+
+
+def _connect(key):
+    sock = socket.socket()
+    try:
+        sock.settimeout(SOCKET_TIMEOUT_S)
+        sock.connect(_get_address(key))
+    except:
+        sock.close()
+        # The address may have changed
+        _addresses.pop(key, None)
+        raise
+    return sock
+
+
+class Response:
+    """Body of a response, read from a connection that is reused afterwards
+
+    The connection is returned to the pool when the body has been read to the
+    end. Closing the response before that closes the connection.
+    """
+
+    def __init__(self, sock, key, status, headers):
+        self.status = status
+        self.headers = headers
+        self._sock = sock
+        self._key = key
+        self._chunked = headers.get("transfer-encoding") == "chunked"
+        self._remaining = None
+        if "content-length" in headers:
+            self._remaining = int(headers["content-length"])
+        self._chunk_remaining = 0
+        self._keep_alive = headers.get("connection", "").lower() != "close" and (
+            status == 304 or self._chunked or self._remaining is not None
+        )
+        if status == 304 or self._remaining == 0:
+            self._finish()
+
+    def readinto(self, buffer):
+        if self._sock is None:
+            return 0
+        view = memoryview(buffer)
+        if self._chunked:
+            if not self._chunk_remaining:
+                self._chunk_remaining = int(self._readline().split(b";")[0], 16)
+                if not self._chunk_remaining:
+                    while self._readline().strip():
+                        pass  # ignore trailers
+                    self._finish()
+                    return 0
+            view = view[: self._chunk_remaining]
+        elif self._remaining is not None:
+            view = view[: self._remaining]
+        n_read = self._sock.readinto(view)
+        if not n_read:
+            if self._chunked or self._remaining:
+                raise OSError("connection closed before the end of the body")
+            self._finish()
+            return 0
+        if self._chunked:
+            self._chunk_remaining -= n_read
+            if not self._chunk_remaining:
+                self._readline()
+        elif self._remaining is not None:
+            self._remaining -= n_read
+            if not self._remaining:
+                self._finish()
+        return n_read
+
+    def read(self, n):
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        total = 0
+        while total < n:
+            n_read = self.readinto(view[total:])
+            if not n_read:
+                break
+            total += n_read
+        return bytes(view[:total])
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _readline(self):
+        line = self._sock.readline()
+        if not line:
+            raise OSError("connection closed before the end of the body")
+        return line
+
+    def _finish(self):
+        if self._keep_alive and self._key not in _idle_connections:
+            _idle_connections[self._key] = self._sock
+        else:
+            self._sock.close()
+        self._sock = None
+
+
+def _send_get_request(sock, key, host, path, accept, headers):
+    extra_headers = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
     sock.sendall(
-        f"GET {path} HTTP/1.0\r\nHost: {host}\r\nUser-Agent: lotina/0.1\r\nAccept: {'; '.join(accept or ['*/*'])}\r\n\r\n".encode()
+        f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: lotina/0.1\r\nAccept: {'; '.join(accept or ['*/*'])}\r\n{extra_headers}\r\n".encode()
     )
     status = sock.readline()
-    parts = status.split(b" ")
-    if parts[1] != b"200":
+    if not status:
+        raise OSError("connection closed")
+    code = status.split(b" ")[1]
+    if code not in (b"200", b"206", b"304"):
         raise RuntimeError("unsuccessful or unsupported GET request")
+    response_headers = {}
     while True:
         line = sock.readline().strip()
         if not line:
             break
         parts = line.split(b":", 1)
-        header = parts[0].lower()
-        value = parts[1].strip()
-        if header == b"content-type":
-            if accept and value.decode() not in accept:
-                raise RuntimeError(f"unsupported content type: {value}")
-        elif header == b"content-encoding":
-            raise RuntimeError(f"content encoding not supported, got: {value}")
-        elif header == b"transfer-encoding":
-            raise RuntimeError(f"transfer encoding not supported, got: {value}")
-
-
-def open_get_request(url, *, accept=None):
+        response_headers[parts[0].lower().decode()] = parts[1].strip().decode()
+    response = Response(sock, key, int(code), response_headers)
+    if response.status == 304:
+        return None, response_headers
+    content_type = response_headers.get("content-type")
+    if accept and content_type and content_type not in accept:
+        raise RuntimeError(f"unsupported content type: {content_type}")
+    content_encoding = response_headers.get("content-encoding", "identity")
+    if content_encoding != "identity":
+        raise RuntimeError(f"content encoding not supported, got: {content_encoding}")
+    # Without the header, the body is read by Content-Length (or to the end of
+    # the connection)
+    transfer_encoding = response_headers.get("transfer-encoding", "identity")
+    if transfer_encoding not in ("identity", "chunked"):
+        raise RuntimeError(f"transfer encoding not supported, got: {transfer_encoding}")
+    return response, response_headers
+
+
+def open_get_request(url, *, accept=None, headers=None):
+    """Send GET request, and return the response to read the body from
+
+    Returns a tuple containing the response and the response headers (with
+    lowercase names). If conditional request headers are given and the
+    resource is not modified, the response is None. The status of a response
+    to a Range request tells whether the server sent only the range (206) or
+    the whole resource (200).
+    """
     host, path = _parse_url(url)
-    hostname, port = _parse_host(host)
-    addrinfo = socket.getaddrinfo(hostname, port)[0]
-    sock = socket.socket()
+    key = _parse_host(host)
+    sock = _idle_connections.pop(key, None)
+    if sock is not None:
+        try:
+            return _send_get_request(sock, key, host, path, accept, headers or {})
+        except OSError:
+            # The server closed the idle connection, try again with a new one
+            sock.close()
+        except:
+            sock.close()
+            raise
+    sock = _connect(key)
     try:
-        sock.connect(addrinfo[-1])
-        _initiate_get_request(sock, host, path, accept)
+        return _send_get_request(sock, key, host, path, accept, headers or {})
     except:
         sock.close()
         raise
-    else:
-        return sock
@@ -1,8 +1,13 @@
+import array
 import gc
 import json
 import machine
+import math
+import micropython
+from micropython import const
 import time
 
+import bandtables
 import notes
 
 gc.enable()
@@ -27,9 +32,29 @@ AUDIO_SAMPLE_RATE = 22050
 AUDIO_SAMPLE_BITS = 16
 AUDIO_SAMPLE_BUFFER_LENGTH = 16384
 
+CODEC_PCM16 = "pcm16"
+CODEC_MULAW = "mulaw"
+CODEC_BANDS = "bands"
+DECIMATION_SHIFTS = {1: 0, 2: 1}
+
 DETECTION_THRESHOLD = 127
 HAND_WASHING_DETECTED_TIMEOUT_S = 3
 HAND_WASHING_OVER_TIMEOUT_S = 20
+GATE_TIMING_REPORT_INTERVAL = 100
+
+# The processor predicts from windows of three consecutive buffers, so a burst
+# of published buffers must be at least that long to be of any use
+MIN_PUBLISH_BURST = 3
+PAUSED_SLEEP_MS = 100
+# Published before samples that don't follow the previously published ones.
+# Unlike the empty interrupt payload, it doesn't mean that the sound stopped.
+# Audio and band feature payloads are never three bytes long.
+GAP_PAYLOAD = b"gap"
+
+# Constants so that the viper functions below get them inlined
+BAND_FRAME_LENGTH = const(512)
+N_BANDS = const(32)
+BINS_PER_BAND = const(BAND_FRAME_LENGTH // 2 // N_BANDS)
 
 
 def load_config():
@@ -51,10 +76,11 @@ def init_wifi(ssid, passwd):
 
 
 class LotinaEngine:
-    def __init__(self, song_url, publisher):
+    def __init__(self, song_url, publisher, server_detection=False):
         self._initialized = False
+        self._server_detection = server_detection
         self._publisher = publisher
-        self._song_url = song_url
+        self._player = notes.Player(song_url)
         self._prediction = 0
         self._enabled = True
         self._timestamp = time.time()
@@ -65,7 +91,10 @@ class LotinaEngine:
         topic_prefix = self._publisher._topic_prefix
         client.set_callback(self._handle_msg)
         self._publisher.connect()
-        client.subscribe(f"{topic_prefix}/prediction".encode())
+        if self._server_detection:
+            client.subscribe(f"{topic_prefix}/detection".encode())
+        else:
+            client.subscribe(f"{topic_prefix}/prediction".encode())
         client.subscribe(f"{topic_prefix}/enabled".encode())
         client.subscribe(f"{topic_prefix}/set_enabled".encode())
         self._initialized = True
@@ -87,7 +116,7 @@ class LotinaEngine:
     def _transit_to_soap(self):
         self._transit_to(STATE_SOAP)
         self._publisher.publish_interrupt()
-        notes.play(self._song_url)
+        self._player.play()
 
     def _transit_to_hand_washing_over(self):
         self._transit_to(STATE_COOLDOWN)
@@ -96,8 +125,12 @@ class LotinaEngine:
     def is_enabled(self):
         return self._enabled
 
+    def state(self):
+        return self._state
+
     def handle_tick(self):
-        if not self._enabled:
+        self._player.tick()
+        if not self._enabled or self._server_detection:
             return
         if self._state == STATE_IDLE:
             if self._prediction > DETECTION_THRESHOLD:
@@ -112,8 +145,21 @@ class LotinaEngine:
             if time.time() - self._timestamp >= HAND_WASHING_OVER_TIMEOUT_S:
                 self._transit_to_idle()
 
+    def _follow_detection(self, state):
+        # Unlike in _transit_to_soap(), the samples aren't interrupted, since
+        # the processor would take it as the tap being closed
+        if not self._enabled:
+            return
+        if state == STATE_SOAP:
+            self._transit_to(STATE_SOAP)
+            self._player.play()
+        elif state in (STATE_IDLE, STATE_WASHING, STATE_COOLDOWN):
+            self._transit_to(state)
+
     def _handle_msg(self, topic, msg):
-        if topic.endswith(b"/prediction"):
+        if topic.endswith(b"/detection"):
+            self._follow_detection(msg)
+        elif topic.endswith(b"/prediction"):
             try:
                 self._prediction = int(msg)
             except ValueError:
@@ -131,22 +177,255 @@ class LotinaEngine:
                 if self._initialized:
                     self._publisher.publish_enabled(msg)
                     if not self._enabled:
+                        self._player.stop()
                         self._publisher.publish_interrupt()
                         self._transit_to_idle()
 
 
+@micropython.viper
+def _sample_range_exceeds(samples, n: int, threshold: int) -> bool:
+    buf = ptr16(samples)
+    _min = int(buf[0])
+    _max = _min
+    i = 1
+    while i < n:
+        sample = int(buf[i])
+        if sample < _min:
+            _min = sample
+        elif sample > _max:
+            _max = sample
+        if _max - _min > threshold:
+            return True
+        i += 1
+    return False
+
+
+@micropython.viper
+def _sum_of_squares(samples, n: int) -> int:
+    # Samples are signed, and the squares are scaled down to keep the sum of
+    # a whole buffer within a machine word
+    buf = ptr16(samples)
+    total = 0
+    i = 0
+    while i < n:
+        sample = int(buf[i])
+        if sample >= 0x8000:
+            sample -= 0x10000
+        total += (sample * sample) >> 14
+        i += 1
+    return total
+
+
+@micropython.viper
+def _encode_samples(samples, n: int, out, shift: int, mulaw: bool) -> int:
+    # Decimate by averaging 2**shift samples, and optionally encode with G.711
+    # mu-law. Returns the number of encoded samples.
+    src = ptr16(samples)
+    dst8 = ptr8(out)
+    dst16 = ptr16(out)
+    decimation = 1 << shift
+    i = 0
+    j = 0
+    while i + decimation <= n:
+        total = 0
+        k = 0
+        while k < decimation:
+            sample = int(src[i + k])
+            if sample >= 0x8000:
+                sample -= 0x10000
+            total += sample
+            k += 1
+        sample = total >> shift
+        if mulaw:
+            sign = 0
+            if sample < 0:
+                sign = 0x80
+                sample = 0 - sample
+            if sample > 32635:
+                sample = 32635
+            sample += 0x84
+            exponent = 7
+            mask = 0x4000
+            while exponent > 0 and (sample & mask) == 0:
+                exponent -= 1
+                mask >>= 1
+            mantissa = (sample >> (exponent + 3)) & 0x0F
+            dst8[j] = (sign | (exponent << 4) | mantissa) ^ 0xFF
+        else:
+            dst16[j] = sample & 0xFFFF
+        i += decimation
+        j += 1
+    return j
+
+
+def _make_band_tables():
+    # Hann window, FFT twiddle factors and bit reversal permutation packed in
+    # one array, all as Q15 fixed point where applicable. The window and the
+    # twiddle factors come from the same tables as on the server, so that the
+    # features are identical.
+    n = BAND_FRAME_LENGTH
+    tables = array.array("i", bytearray(4 * 3 * n))
+    bits = 0
+    while (1 << bits) < n:
+        bits += 1
+    for i in range(n):
+        tables[i] = bandtables.WINDOW[i]
+        j = 0
+        for b in range(bits):
+            j |= ((i >> b) & 1) << (bits - 1 - b)
+        tables[2 * n + i] = j
+    for k in range(n // 2):
+        tables[n + 2 * k] = bandtables.TWIDDLES_COS[k]
+        tables[n + 2 * k + 1] = bandtables.TWIDDLES_SIN[k]
+    return tables
+
+
+@micropython.viper
+def _load_frame(samples, offset: int, x, tables):
+    # Window the frame starting at sample offset, and store it in bit reversed
+    # order as interleaved real and imaginary parts
+    src = ptr16(samples)
+    dst = ptr32(x)
+    tab = ptr32(tables)
+    n = BAND_FRAME_LENGTH
+    i = 0
+    while i < n:
+        sample = int(src[offset + i])
+        if sample >= 0x8000:
+            sample -= 0x10000
+        j = int(tab[2 * n + i])
+        dst[2 * j] = (sample * int(tab[i])) >> 16
+        dst[2 * j + 1] = 0
+        i += 1
+
+
+@micropython.viper
+def _fft(x, tables):
+    # In place radix-2 FFT of the bit reversed frame. The values are halved at
+    # every stage to avoid overflow, so the result is scaled by 1/512.
+    buf = ptr32(x)
+    tab = ptr32(tables)
+    n = BAND_FRAME_LENGTH
+    size = 2
+    step = n >> 1
+    while size <= n:
+        half = size >> 1
+        start = 0
+        while start < n:
+            j = 0
+            while j < half:
+                wr = int(tab[n + 2 * j * step])
+                wi = int(tab[n + 2 * j * step + 1])
+                a = 2 * (start + j)
+                b = a + 2 * half
+                br = int(buf[b])
+                bi = int(buf[b + 1])
+                tr = (br * wr + bi * wi) >> 15
+                ti = (bi * wr - br * wi) >> 15
+                ar = int(buf[a])
+                ai = int(buf[a + 1])
+                buf[a] = (ar + tr) >> 1
+                buf[a + 1] = (ai + ti) >> 1
+                buf[b] = (ar - tr) >> 1
+                buf[b + 1] = (ai - ti) >> 1
+                j += 1
+            start += size
+        size <<= 1
+        step >>= 1
+
+
+@micropython.viper
+def _quantize_bands(x, out, offset: int):
+    # Sum approximate magnitudes (alpha max plus beta min) of the bins 1..256
+    # over 32 bands, and quantize them to a logarithmic scale with eight steps
+    # per octave
+    buf = ptr32(x)
+    dst = ptr8(out)
+    band = 0
+    k = 1
+    while band < N_BANDS:
+        total = 0
+        end = k + BINS_PER_BAND
+        while k < end:
+            re = int(buf[2 * k])
+            im = int(buf[2 * k + 1])
+            if re < 0:
+                re = 0 - re
+            if im < 0:
+                im = 0 - im
+            if re > im:
+                total += re + (im >> 1)
+            else:
+                total += im + (re >> 1)
+            k += 1
+        quantized = 0
+        if total > 0:
+            length = 0
+            value = total
+            while value:
+                length += 1
+                value >>= 1
+            if length >= 4:
+                fraction = total >> (length - 4)
+            else:
+                fraction = total << (4 - length)
+            quantized = 8 * (length - 1) + (fraction & 7) + 1
+        dst[offset + band] = quantized
+        band += 1
+
+
+def _rms(samples):
+    n = len(samples) // 2
+    return math.sqrt((_sum_of_squares(samples, n) << 14) / n)
+
+
 class SamplePublisher:
-    def __init__(self, topic_prefix, client, sample_publish_threshold):
+    def __init__(
+        self,
+        topic_prefix,
+        client,
+        sample_publish_threshold,
+        sample_publish_rms_threshold=0,
+        gate_timing=False,
+        uplink_codec=CODEC_PCM16,
+        uplink_decimation=1,
+    ):
         self._topic_prefix = topic_prefix
         self._samples_topic = f"{topic_prefix}/samples".encode()
         self._state_topic = f"{topic_prefix}/state".encode()
         self._availability_topic = f"{topic_prefix}/availability".encode()
         self._enabled_topic = f"{topic_prefix}/enabled".encode()
         self._set_enabled_topic = f"{topic_prefix}/set_enabled".encode()
+        self._format_topic = f"{topic_prefix}/format".encode()
         self._client = client
         self._sample_publish_threshold = sample_publish_threshold
+        self._sample_publish_rms_threshold = sample_publish_rms_threshold
+        self._gate_timing = gate_timing
+        self._gate_time_us = 0
+        self._gate_count = 0
         self._audio_above_threshold_detected = True
+        self._gap = False
         self._last_availability_timestamp = 0
+        if uplink_codec not in (CODEC_PCM16, CODEC_MULAW, CODEC_BANDS):
+            raise ValueError(f"unsupported uplink codec: {uplink_codec}")
+        if uplink_decimation not in DECIMATION_SHIFTS or (
+            uplink_codec == CODEC_BANDS and uplink_decimation != 1
+        ):
+            raise ValueError(f"unsupported uplink decimation: {uplink_decimation}")
+        self._uplink_format = (
+            f"{uplink_codec}/{AUDIO_SAMPLE_RATE // uplink_decimation}".encode()
+        )
+        self._uplink_shift = DECIMATION_SHIFTS[uplink_decimation]
+        self._uplink_mulaw = uplink_codec == CODEC_MULAW
+        self._uplink_bands = uplink_codec == CODEC_BANDS
+        self._uplink_buffer = None
+        if self._uplink_bands:
+            n_frames = AUDIO_SAMPLE_BUFFER_LENGTH // 2 // BAND_FRAME_LENGTH
+            self._uplink_buffer = bytearray(n_frames * N_BANDS)
+            self._band_tables = _make_band_tables()
+            self._fft_buffer = array.array("i", bytearray(8 * BAND_FRAME_LENGTH))
+        elif self._uplink_shift or self._uplink_mulaw:
+            self._uplink_buffer = bytearray(AUDIO_SAMPLE_BUFFER_LENGTH)
 
     def connect(self):
         self._client.set_last_will(
@@ -154,6 +433,9 @@ class SamplePublisher:
         )
         self._client.connect()
         self._client.publish(self._availability_topic, STATE_ONLINE, retain=True, qos=1)
+        self._client.publish(
+            self._format_topic, self._uplink_format, retain=True, qos=1
+        )
 
     def keepalive(self):
         t = time.time()
@@ -171,20 +453,127 @@ class SamplePublisher:
         if self._audio_above_threshold_detected:
             self._client.publish(self._samples_topic, b"")
         self._audio_above_threshold_detected = False
+        self._gap = False
 
-    def publish_samples(self, samples):
-        _min = _max = int.from_bytes(samples[:2], "little")
-        for i in range(2, len(samples), 2):
-            sample = int.from_bytes(samples[i : i + 2], "little")
-            if sample < _min:
-                _min = sample
-            elif sample > _max:
-                _max = sample
-            if _max - _min > self._sample_publish_threshold:
-                self._audio_above_threshold_detected = True
-                self._client.publish(self._samples_topic, samples)
-                return
-        self.publish_interrupt()
+    def mark_gap(self):
+        """Tell that the audio since the last published samples was skipped"""
+        self._gap = True
+
+    def _is_above_threshold(self, samples):
+        if not _sample_range_exceeds(
+            samples, len(samples) // 2, self._sample_publish_threshold
+        ):
+            return False
+        return (
+            not self._sample_publish_rms_threshold
+            or _rms(samples) > self._sample_publish_rms_threshold
+        )
+
+    def _encode_bands(self, samples):
+        n_frames = len(samples) // 2 // BAND_FRAME_LENGTH
+        for frame in range(n_frames):
+            _load_frame(
+                samples, frame * BAND_FRAME_LENGTH, self._fft_buffer, self._band_tables
+            )
+            _fft(self._fft_buffer, self._band_tables)
+            _quantize_bands(self._fft_buffer, self._uplink_buffer, frame * N_BANDS)
+        return memoryview(self._uplink_buffer)[: n_frames * N_BANDS]
+
+    def _encode(self, samples):
+        if not self._uplink_buffer:
+            return samples
+        if self._uplink_bands:
+            return self._encode_bands(samples)
+        n = _encode_samples(
+            samples,
+            len(samples) // 2,
+            self._uplink_buffer,
+            self._uplink_shift,
+            self._uplink_mulaw,
+        )
+        return memoryview(self._uplink_buffer)[: n if self._uplink_mulaw else 2 * n]
+
+    def _report_gate_timing(self, elapsed_us):
+        self._gate_time_us += elapsed_us
+        self._gate_count += 1
+        if self._gate_count == GATE_TIMING_REPORT_INTERVAL:
+            print("gate time (us):", self._gate_time_us // self._gate_count)
+            self._gate_time_us = 0
+            self._gate_count = 0
+
+    def publish_samples(self, samples, publish=True):
+        """Publish the samples if they are above the threshold
+
+        If publish is false, the samples are only checked against the threshold
+        without interrupting the stream, and a gap marker precedes the next
+        published samples. Returns whether the samples were above the
+        threshold.
+        """
+        start = time.ticks_us()
+        above_threshold = self._is_above_threshold(samples)
+        if self._gate_timing:
+            self._report_gate_timing(time.ticks_diff(time.ticks_us(), start))
+        if not above_threshold:
+            self.publish_interrupt()
+        elif publish:
+            if self._gap and self._audio_above_threshold_detected:
+                self._client.publish(self._samples_topic, GAP_PAYLOAD)
+            self._gap = False
+            self._audio_above_threshold_detected = True
+            self._client.publish(self._samples_topic, self._encode(samples))
+        else:
+            self._gap = True
+        return above_threshold
+
+
+class DutyCycle:
+    """Policy deciding which buffers are read and published in each state
+
+    The policy maps states to (burst, period) pairs: the first burst buffers of
+    every period buffers are published. A burst of zero stops reading audio
+    altogether. In idle state, reading is throttled after a long silence.
+    """
+
+    def __init__(self, policy, idle_throttle_after_s=0, idle_throttle_sleep_ms=0):
+        self._policy = {}
+        for state, (burst, period) in policy.items():
+            if burst and (burst < MIN_PUBLISH_BURST or period < burst):
+                raise ValueError(f"invalid duty cycle for {state}: {burst}/{period}")
+            self._policy[state.encode()] = (burst, period)
+        self._idle_throttle_after_ms = int(1000 * idle_throttle_after_s)
+        self._idle_throttle_sleep_ms = idle_throttle_sleep_ms
+        self._state = None
+        self._count = 0
+        self._silent_since = time.ticks_ms()
+
+    def set_state(self, state):
+        if state != self._state:
+            self._state = state
+            self._count = 0
+            self._silent_since = time.ticks_ms()
+
+    def is_reading(self):
+        return self._policy.get(self._state, (1, 1))[0] > 0
+
+    def next_publish(self):
+        burst, period = self._policy.get(self._state, (1, 1))
+        publish = self._count < burst
+        self._count = (self._count + 1) % period
+        return publish
+
+    def sleep_ms(self, above_threshold):
+        """Return how long to sleep after reading a buffer"""
+        now = time.ticks_ms()
+        if above_threshold:
+            self._silent_since = now
+            return 0
+        if (
+            self._idle_throttle_after_ms
+            and self._state == STATE_IDLE
+            and time.ticks_diff(now, self._silent_since) >= self._idle_throttle_after_ms
+        ):
+            return self._idle_throttle_sleep_ms
+        return 0
 
 
 def publish_discovery(client, discovery_prefix, component, object_id, suffix, **config):
@@ -209,6 +598,14 @@ def process_messages(
     mqtt_passwd,
     song_url,
     sample_publish_threshold,
+    sample_publish_rms_threshold,
+    gate_timing,
+    uplink_codec,
+    uplink_decimation,
+    server_detection,
+    duty_cycle,
+    idle_throttle_after_s,
+    idle_throttle_sleep_ms,
     discovery_prefix,
 ):
     from umqtt.simple import MQTTClient
@@ -238,9 +635,18 @@ def process_messages(
     )
 
     topic_prefix = f"lotina/{identity}"
-    publisher = SamplePublisher(topic_prefix, client, sample_publish_threshold)
+    publisher = SamplePublisher(
+        topic_prefix,
+        client,
+        sample_publish_threshold,
+        sample_publish_rms_threshold,
+        gate_timing,
+        uplink_codec,
+        uplink_decimation,
+    )
 
-    engine = LotinaEngine(song_url, publisher)
+    duty_cycle = DutyCycle(duty_cycle, idle_throttle_after_s, idle_throttle_sleep_ms)
+    engine = LotinaEngine(song_url, publisher, server_detection)
     engine.start()
     print("engine started...")
 
@@ -267,10 +673,21 @@ def process_messages(
     while True:
         publisher.keepalive()
         client.check_msg()
-        if engine.is_enabled():
+        duty_cycle.set_state(engine.state())
+        if engine.is_enabled() and duty_cycle.is_reading():
             audio_in.readinto(samples)
-            publisher.publish_samples(samples)
-            engine.handle_tick()
+            above_threshold = publisher.publish_samples(
+                samples, duty_cycle.next_publish()
+            )
+            sleep_ms = duty_cycle.sleep_ms(above_threshold)
+        else:
+            publisher.mark_gap()
+            sleep_ms = PAUSED_SLEEP_MS
+        engine.handle_tick()
+        if sleep_ms:
+            # The audio isn't read while sleeping
+            publisher.mark_gap()
+            time.sleep_ms(sleep_ms)
 
 
 def main():
@@ -285,6 +702,14 @@ def main():
         mqtt_passwd=config["mqtt_passwd"],
         song_url=config["song_url"],
         sample_publish_threshold=config.get("sample_publish_threshold", 0),
+        sample_publish_rms_threshold=config.get("sample_publish_rms_threshold", 0),
+        gate_timing=config.get("gate_timing", False),
+        uplink_codec=config.get("uplink_codec", CODEC_PCM16),
+        uplink_decimation=config.get("uplink_decimation", 1),
+        server_detection=config.get("server_detection", False),
+        duty_cycle=config.get("duty_cycle", {}),
+        idle_throttle_after_s=config.get("idle_throttle_after_s", 0),
+        idle_throttle_sleep_ms=config.get("idle_throttle_sleep_ms", 500),
         discovery_prefix=config.get("discovery_prefix"),
         device_name=config.get("device_name"),
     )
@@ -1,6 +1,9 @@
 import http
+import json
 import machine
+import os
 import struct
+import time
 
 SCK_PIN_OUT = machine.Pin(14)  # audio out BCLK
 WS_PIN_OUT = machine.Pin(13)  # audio out LRC
@@ -9,6 +12,11 @@ BUFFER_SIZE = 16384
 
 CONTENT_TYPES = ["audio/wav", "audio/x-wav"]
 
+SONG_CACHE_PATH = "song.wav"
+SONG_CACHE_INFO_PATH = "song.json"
+SONG_REVALIDATE_INTERVAL_S = 3600
+SONG_DOWNLOAD_RETRY_INTERVAL_S = 10
+
 
 def _parse_wav_file(infile):
     magic = infile.read(4)
@@ -55,22 +63,323 @@ def _prepare_i2s_bus(n_channels, sample_rate, bits_per_sample):
     )
 
 
-def play(url):
-    infile = http.open_get_request(url, accept=CONTENT_TYPES)
-    audio_out = None
+def _read_fully(infile, buffer, n):
+    # Socket reads may return less than requested before the end of stream
+    view = memoryview(buffer)
+    total = 0
+    while total < n:
+        n_read = infile.readinto(view[total:n])
+        if not n_read:
+            break
+        total += n_read
+    return total
+
+
+def _remove(path):
     try:
-        n_channels, sample_rate, bits_per_sample, data_size = _parse_wav_file(infile)
-        audio_out = _prepare_i2s_bus(n_channels, sample_rate, bits_per_sample)
-        samples = bytearray(BUFFER_SIZE)
-        while data_size > 0:
-            n_read = infile.readinto(samples, min(BUFFER_SIZE, data_size))
-            data_size -= n_read
-            if n_read == 0:
-                break
-            audio_out.write(samples)
-    except Exception as e:
-        print(f"error playing tone: {e}")
-    finally:
-        if audio_out:
-            audio_out.deinit()
-        infile.close()
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SongCache:
+    """Copy of the song in flash, revalidated with the validators of the server"""
+
+    def __init__(self, url):
+        self._url = url
+        self._info = None
+        self._download = None
+        self._partial = None
+        self._retry_at = 0
+        self._revalidated_at = None
+        try:
+            with open(SONG_CACHE_INFO_PATH) as f:
+                info = json.load(f)
+            if info.get("url") == url:
+                self._info = info
+        except (OSError, ValueError):
+            pass
+
+    def open(self):
+        """Open the cached song, or None if it is not cached"""
+        if self._info is None:
+            return None
+        try:
+            return open(SONG_CACHE_PATH, "rb")
+        except OSError:
+            self._info = None
+            return None
+
+    def open_stream(self):
+        """Request the song for playing it while it is downloaded
+
+        Returns a reader of the whole song, which writes what it downloads to
+        the cache. A download in progress or interrupted earlier is resumed, in
+        which case the part already in flash is read from there. The caller
+        finishes with finish_download().
+        """
+        if self._download is not None:
+            # Continue the download as part of the stream instead
+            self._download[0].close()
+            self.finish_download(False)
+        if self._partial is not None:
+            size = os.stat(SONG_CACHE_PATH + ".tmp")[6]
+            status = self._resume()
+            if status == 206:
+                return _CachingReader(
+                    self._download[0], self, open(SONG_CACHE_PATH + ".tmp", "rb"), size
+                )
+            if status is not None:
+                return _CachingReader(self._download[0], self)
+        infile, headers = http.open_get_request(self._url, accept=CONTENT_TYPES)
+        self._start_download(infile, headers)
+        return _CachingReader(infile, self)
+
+    def write(self, data):
+        if self._download:
+            self._download[1].write(data)
+
+    def finish_download(self, complete):
+        if not self._download:
+            return
+        infile, outfile, headers = self._download
+        self._download = None
+        outfile.close()
+        if not complete:
+            if headers.get("etag") or headers.get("last-modified"):
+                # Keep what was downloaded, and resume from there later
+                print("song download interrupted")
+                self._partial = headers
+            else:
+                _remove(SONG_CACHE_PATH + ".tmp")
+            return
+        os.rename(SONG_CACHE_PATH + ".tmp", SONG_CACHE_PATH)
+        self._info = dict(
+            url=self._url,
+            etag=headers.get("etag"),
+            last_modified=headers.get("last-modified"),
+        )
+        with open(SONG_CACHE_INFO_PATH, "w") as f:
+            json.dump(self._info, f)
+        self._revalidated_at = time.time()
+        print("song cached")
+
+    def is_downloading(self):
+        return self._download is not None or self._partial is not None
+
+    def needs_revalidation(self):
+        return self._info is not None and (
+            self._revalidated_at is None
+            or time.time() - self._revalidated_at >= SONG_REVALIDATE_INTERVAL_S
+        )
+
+    def revalidate(self):
+        """Send conditional request, and start downloading if the song changed
+
+        The new version is downloaded with step() while the old one can still
+        be played.
+        """
+        self._revalidated_at = time.time()
+        headers = {}
+        if self._info.get("etag"):
+            headers["If-None-Match"] = self._info["etag"]
+        if self._info.get("last_modified"):
+            headers["If-Modified-Since"] = self._info["last_modified"]
+        try:
+            infile, response_headers = http.open_get_request(
+                self._url, accept=CONTENT_TYPES, headers=headers
+            )
+        except Exception as e:
+            print(f"error revalidating song: {e}")
+            return
+        if infile is None:
+            return
+        print("song changed, downloading...")
+        self._start_download(infile, response_headers)
+
+    def step(self, buffer):
+        """Download the next part of the song"""
+        if self._download is None:
+            if time.time() >= self._retry_at:
+                self._resume()
+            return
+        infile = self._download[0]
+        try:
+            n_read = _read_fully(infile, buffer, len(buffer))
+            self.write(memoryview(buffer)[:n_read])
+        except Exception as e:
+            print(f"error downloading song: {e}")
+            infile.close()
+            self.finish_download(False)
+            return
+        if n_read < len(buffer):
+            infile.close()
+            self.finish_download(True)
+
+    def _start_download(self, infile, headers, mode="wb"):
+        self._download = (infile, open(SONG_CACHE_PATH + ".tmp", mode), headers)
+        self._partial = None
+
+    def _resume(self):
+        # Request the rest of the song, unless it has changed since. Returns
+        # the status of the response, or None if the request failed.
+        self._retry_at = time.time() + SONG_DOWNLOAD_RETRY_INTERVAL_S
+        size = os.stat(SONG_CACHE_PATH + ".tmp")[6]
+        headers = {
+            "Range": f"bytes={size}-",
+            "If-Range": self._partial.get("etag") or self._partial["last-modified"],
+        }
+        try:
+            infile, response_headers = http.open_get_request(
+                self._url, accept=CONTENT_TYPES, headers=headers
+            )
+        except Exception as e:
+            print(f"error resuming song download: {e}")
+            return None
+        if infile.status == 206:
+            print(f"resuming song download at {size} bytes")
+            self._start_download(infile, self._partial, "ab")
+        else:
+            self._start_download(infile, response_headers)
+        return infile.status
+
+
+class Player:
+    """Non-blocking song player
+
+    The song is written to the I2S bus from two alternating buffers. When the
+    bus has consumed one, the IRQ callback hands the other one over and refills
+    the consumed one. The callback is scheduled to run in the main thread (also
+    while it is blocked reading audio), and tick() only cleans up after the song
+    ends. The song is played from the flash cache if possible, otherwise
+    streamed while being cached. A partially downloaded song is played from
+    the part in flash while the rest is streamed.
+    """
+
+    def __init__(self, url):
+        self._cache = SongCache(url)
+        self._buffers = [bytearray(BUFFER_SIZE), bytearray(BUFFER_SIZE)]
+        self._lengths = [0, 0]
+        self._writing = None
+        self._error = None
+        self._infile = None
+        self._streaming = False
+        self._remaining = 0
+        self._audio_out = None
+
+    def is_playing(self):
+        return self._infile is not None
+
+    def play(self):
+        if self.is_playing():
+            return
+        try:
+            self._start()
+        except Exception as e:
+            print(f"error playing song: {e}")
+            self.stop()
+
+    def stop(self):
+        if self._audio_out:
+            self._audio_out.deinit()
+            self._audio_out = None
+        if self._infile:
+            self._infile.close()
+            self._infile = None
+            if self._streaming:
+                self._cache.finish_download(False)
+        self._writing = None
+
+    def tick(self):
+        if self.is_playing():
+            if self._error:
+                print(f"error playing song: {self._error}")
+                self._error = None
+                self.stop()
+            elif self._writing is None:
+                self._finish()
+        elif self._cache.is_downloading():
+            self._cache.step(self._buffers[0])
+        elif self._cache.needs_revalidation():
+            self._cache.revalidate()
+
+    def _start(self):
+        self._infile = self._cache.open()
+        self._streaming = self._infile is None
+        if self._streaming:
+            self._infile = self._cache.open_stream()
+        n_channels, sample_rate, bits_per_sample, data_size = _parse_wav_file(
+            self._infile
+        )
+        self._remaining = data_size
+        self._audio_out = _prepare_i2s_bus(n_channels, sample_rate, bits_per_sample)
+        self._fill(0)
+        self._fill(1)
+        self._audio_out.irq(self._on_written)
+        self._write(0)
+
+    def _finish(self):
+        if self._streaming:
+            self._infile.close()
+            self._infile = None
+            self._cache.finish_download(self._remaining == 0)
+        self.stop()
+
+    def _fill(self, index):
+        n_read = _read_fully(
+            self._infile, self._buffers[index], min(BUFFER_SIZE, self._remaining)
+        )
+        self._remaining -= n_read
+        self._lengths[index] = n_read
+
+    def _write(self, index):
+        self._writing = index
+        self._audio_out.write(memoryview(self._buffers[index])[: self._lengths[index]])
+
+    def _on_written(self, audio_out):
+        index = self._writing
+        if index is None:
+            return
+        self._writing = None
+        if self._lengths[1 - index]:
+            self._write(1 - index)
+        try:
+            self._fill(index)
+        except Exception as e:
+            self._error = e
+
+
+class _CachingReader:
+    # Reads the song from the response and writes it to the cache. A resumed
+    # download starts with the prefix already in flash.
+    def __init__(self, infile, cache, prefix=None, prefix_size=0):
+        self._infile = infile
+        self._cache = cache
+        self._prefix = prefix if prefix_size else None
+        self._prefix_remaining = prefix_size
+        if prefix and not prefix_size:
+            prefix.close()
+
+    def readinto(self, buffer):
+        if self._prefix is not None:
+            n_read = self._prefix.readinto(memoryview(buffer)[: self._prefix_remaining])
+            self._prefix_remaining -= n_read
+            if not n_read or not self._prefix_remaining:
+                self._prefix.close()
+                self._prefix = None
+            if n_read:
+                return n_read
+        n_read = self._infile.readinto(buffer)
+        if n_read:
+            self._cache.write(memoryview(buffer)[:n_read])
+        return n_read
+
+    def read(self, n):
+        buffer = bytearray(n)
+        return bytes(memoryview(buffer)[: _read_fully(self, buffer, n)])
+
+    def close(self):
+        if self._prefix is not None:
+            self._prefix.close()
+            self._prefix = None
+        self._infile.close()
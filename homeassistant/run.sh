@@ -4,4 +4,4 @@ export MQTT_BROKER=$(bashio::services mqtt "host")
 export MQTT_USER=$(bashio::services mqtt "username")
 export MQTT_PASSWD=$(bashio::services mqtt "password")
 
-python3 -m lotina process --classify
+python3 -m lotina process --classify --backend tflite
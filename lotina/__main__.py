@@ -10,27 +10,307 @@ def cli():
 @cli.command()
 @click.option("--evaluate/--no-evaluate", default=True, help="Evaluate model")
 @click.option("--save/--no-save", default=False, help="Save model")
-def train(evaluate, save):
+@click.option(
+    "--quantize/--no-quantize",
+    default=False,
+    help="Quantize the exported TensorFlow Lite model to int8",
+)
+@click.option(
+    "--features",
+    type=click.Choice(["spectrogram", "bands"]),
+    default="spectrogram",
+    help="Train on spectrograms or on band features computed on the device",
+)
+@click.option(
+    "--patience",
+    default=20,
+    help="Epochs without improvement before stopping early, or 0 to never stop",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Resume interrupted training from the checkpoints",
+)
+@click.option(
+    "--jit-compile/--no-jit-compile",
+    default=False,
+    help="Compile the training step with XLA",
+)
+@click.option("--threads", type=int, help="Number of threads TensorFlow uses")
+def train(evaluate, save, quantize, features, patience, resume, jit_compile, threads):
     """Train model from audio samples"""
 
     from .modeltraining import train
 
-    train(evaluate, save)
+    train(
+        evaluate,
+        save,
+        quantize,
+        features,
+        patience=patience,
+        resume=resume,
+        jit_compile=jit_compile,
+        n_threads=threads,
+    )
 
 
 @cli.command()
 @click.option("--label")
 @click.option("--classify/--no-classify", default=False)
-def process(label, classify):
+@click.option(
+    "--backend",
+    type=click.Choice(["tf", "tflite"]),
+    default="tf",
+    help="Inference backend: TensorFlow SavedModel or TensorFlow Lite",
+)
+@click.option(
+    "--features",
+    type=click.Choice(["spectrogram", "bands"]),
+    default="spectrogram",
+    help="Features the model uses: server side spectrogram or device band features",
+)
+@click.option(
+    "--max-devices", default=256, help="Maximum number of devices tracked at once"
+)
+@click.option(
+    "--device-idle-timeout",
+    default=600.0,
+    help="Seconds after which an idle device is forgotten",
+)
+@click.option(
+    "--max-batch-size", default=32, help="Maximum number of windows in one model call"
+)
+@click.option(
+    "--max-batch-wait",
+    default=5.0,
+    help="Milliseconds to wait for more windows before running the model",
+)
+@click.option(
+    "--track/--no-track",
+    default=False,
+    help="Track the hand washing state of the devices, and publish only its changes",
+)
+@click.option(
+    "--gate-min-level",
+    default=0.0,
+    help="Predict zero without the model if the RMS of the audio is below this",
+)
+@click.option(
+    "--gate-min-band-level",
+    default=0.0,
+    help="Predict zero without the model if the mean of the band features "
+    "received from the device is below this",
+)
+@click.option(
+    "--gate-max-flux",
+    default=0.0,
+    help="Reuse the previous prediction if the relative spectral change is below this",
+)
+@click.option(
+    "--asyncio/--no-asyncio",
+    "asyncio_mode",
+    default=False,
+    help="Process messages in an asyncio event loop with bounded device queues",
+)
+@click.option(
+    "--queue-size", default=4, help="Maximum number of queued messages per device"
+)
+@click.option(
+    "--max-message-age",
+    default=2.0,
+    help="Seconds after which a queued message is dropped as stale",
+)
+@click.option("--workers", default=4, help="Number of threads computing features")
+@click.option(
+    "--shards",
+    default=1,
+    help="Number of worker processes, each handling a fixed share of the devices",
+)
+@click.option(
+    "--stats-interval",
+    default=60.0,
+    help="Seconds between publishing the metrics, or 0 to disable",
+)
+@click.option(
+    "--metrics-port", type=int, help="Serve the metrics for Prometheus on the port"
+)
+def process(
+    label,
+    classify,
+    backend,
+    features,
+    max_devices,
+    device_idle_timeout,
+    max_batch_size,
+    max_batch_wait,
+    track,
+    gate_min_level,
+    gate_min_band_level,
+    gate_max_flux,
+    asyncio_mode,
+    queue_size,
+    max_message_age,
+    workers,
+    shards,
+    stats_interval,
+    metrics_port,
+):
     """MQTT message processor"""
 
     from .processor import process
 
-    process(label, classify)
+    process(
+        label,
+        classify,
+        backend=backend,
+        features=features,
+        max_devices=max_devices,
+        device_idle_timeout=device_idle_timeout,
+        max_batch_size=max_batch_size,
+        max_batch_wait_ms=max_batch_wait,
+        track=track,
+        asyncio_mode=asyncio_mode,
+        queue_size=queue_size,
+        max_message_age=max_message_age,
+        n_workers=workers,
+        stats_interval=stats_interval,
+        metrics_port=metrics_port,
+        n_shards=shards,
+        gate_min_level=gate_min_level,
+        gate_min_band_level=gate_min_band_level,
+        gate_max_flux=gate_max_flux,
+    )
+
+
+def _parse_layer_widths(ctx, param, values):
+    try:
+        widths = [
+            tuple(int(width) for width in value.split(",") if width) for value in values
+        ]
+    except ValueError:
+        raise click.BadParameter("expected comma separated integers")
+    if any(width <= 0 for layer_widths in widths for width in layer_widths):
+        raise click.BadParameter("widths must be positive")
+    return widths
+
+
+def _check_powers_of_two(ctx, param, values):
+    # The hop is half a segment, so a segment needs at least two samples
+    if any(value < 2 or value & (value - 1) for value in values):
+        raise click.BadParameter("expected powers of two of at least 2")
+    return values
 
 
 @cli.command()
-@click.argument("id")
+@click.option(
+    "--conv-filters",
+    multiple=True,
+    default=["32"],
+    callback=_parse_layer_widths,
+    help="Filters of each convolution, comma separated (repeat to sweep)",
+)
+@click.option(
+    "--dense-units",
+    multiple=True,
+    default=["16"],
+    callback=_parse_layer_widths,
+    help="Units of each dense layer, comma separated (repeat to sweep)",
+)
+@click.option(
+    "--sequence-length",
+    multiple=True,
+    type=click.IntRange(min=2),
+    default=[10],
+    help="Frames per window, overlapping by half",
+)
+@click.option(
+    "--n-segments",
+    multiple=True,
+    type=int,
+    default=[1024],
+    callback=_check_powers_of_two,
+    help="STFT segment length",
+)
+@click.option(
+    "--learning-rate",
+    multiple=True,
+    type=click.FloatRange(min=0, min_open=True),
+    default=[0.001],
+)
+@click.option(
+    "--random",
+    "n_random",
+    type=int,
+    help="Number of combinations to sample instead of trying all of them",
+)
+@click.option("--seed", default=0, help="Seed of the random sampling")
+@click.option(
+    "--features",
+    type=click.Choice(["spectrogram", "bands"]),
+    default="spectrogram",
+)
+@click.option("--epochs", default=200, help="Maximum number of epochs per trial")
+@click.option("--patience", default=20, help="Epochs without improvement per trial")
+@click.option("--processes", default=2, help="Number of trials run in parallel")
+@click.option("--threads", default=1, help="Number of TensorFlow threads per trial")
+@click.option(
+    "--latency-threads",
+    default=1,
+    help="Number of TensorFlow Lite threads the latency is measured with",
+)
+@click.option(
+    "--min-accuracy", default=0.95, help="Accuracy the fastest model must reach"
+)
+@click.option("--output", default="sweep.csv", help="CSV file of the results")
+def sweep(
+    conv_filters,
+    dense_units,
+    sequence_length,
+    n_segments,
+    learning_rate,
+    n_random,
+    seed,
+    features,
+    epochs,
+    patience,
+    processes,
+    threads,
+    latency_threads,
+    min_accuracy,
+    output,
+):
+    """Search for the fastest model that is accurate enough
+
+    Trains every combination of the given parameters, and measures the test
+    accuracy and the latency and size of the TensorFlow Lite model.
+    """
+
+    from .sweep import sweep
+
+    grid = dict(
+        conv_filters=conv_filters,
+        dense_units=dense_units,
+        sequence_length=sequence_length,
+        n_segments=n_segments,
+        learning_rate=learning_rate,
+    )
+    sweep(
+        grid,
+        n_random=n_random,
+        seed=seed,
+        features=features,
+        epochs=epochs,
+        patience=patience,
+        n_processes=processes,
+        n_threads=threads,
+        latency_threads=latency_threads,
+        min_accuracy=min_accuracy,
+        output=output,
+    )
+
+
+@cli.command()
+@click.argument("id", type=int)
 def play(id):
     """Play sample
 
@@ -42,5 +322,186 @@ def play(id):
     play(id)
 
 
+@cli.group()
+def samples():
+    """Inspect the recorded samples"""
+
+
+@samples.command("list")
+@click.option("--label", "labels", multiple=True, help="Only list samples with label")
+@click.option(
+    "--device", "device_ids", multiple=True, help="Only list samples from device"
+)
+@click.option("--min-duration", type=float, help="Minimum duration in seconds")
+@click.option("--limit", type=int, help="Maximum number of samples to list")
+def list_samples(labels, device_ids, min_duration, limit):
+    """List the metadata of the samples"""
+
+    from .samples import list_samples
+
+    list_samples(
+        labels=labels, device_ids=device_ids, min_duration=min_duration, limit=limit
+    )
+
+
+@samples.command()
+def stats():
+    """Show the number and the total duration of the samples by label"""
+
+    from .samples import show_stats
+
+    show_stats()
+
+
+@cli.command()
+def migrate():
+    """Create or update the database tables
+
+    Also computes the metadata of the samples recorded before it was stored.
+    Run this after installing or upgrading, before recording or training.
+    """
+
+    from .samples import migrate
+
+    migrate()
+
+
+@cli.command("band-tables")
+@click.option("--output", default="esp32/bandtables.py", help="Module to write")
+def band_tables(output):
+    """Write the fixed point tables of the band features for the device"""
+
+    from .model import format_band_tables
+
+    with open(output, "w") as f:
+        f.write(format_band_tables())
+
+
+@cli.group()
+def bench():
+    """Benchmarks"""
+
+
+@bench.command()
+@click.option("--batch-size", default=1, help="Number of windows in one model call")
+@click.option("--runs", default=100, help="Number of timed model calls")
+def backends(batch_size, runs):
+    """Compare inference backends
+
+    Report the load time, first and steady state model call latency, peak
+    memory usage and the maximum prediction difference of each backend.
+    """
+
+    from .bench import compare_backends
+
+    compare_backends(batch_size, runs)
+
+
+@bench.command()
+@click.option("--batches", default=500, help="Number of batches to iterate")
+def dataset(batches):
+    """Measure training dataset performance
+
+    Report the time it takes to construct the training dataset, and the number
+    of examples per second when iterating it.
+    """
+
+    from .bench import measure_dataset
+
+    measure_dataset(batches)
+
+
+@bench.command()
+@click.option(
+    "--sample",
+    "sample_ids",
+    type=int,
+    multiple=True,
+    help="Sample to replay, can be given multiple times",
+)
+@click.option(
+    "--fixture",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Raw 16-bit PCM or WAV file to replay instead of samples",
+)
+@click.option("--devices", default=1, help="Number of simulated devices")
+@click.option(
+    "--rate",
+    default=2.7,
+    help="Messages per second per device (an ESP32 sends about 2.7)",
+)
+@click.option("--duration", default=30.0, help="Seconds to replay")
+@click.option(
+    "--find-max/--no-find-max",
+    default=False,
+    help="Double the number of devices until the processor can't keep up",
+)
+@click.option(
+    "--max-latency", default=0.5, help="Maximum sustainable p99 latency in seconds"
+)
+@click.option("--max-devices", default=256, help="Maximum number of devices to try")
+@click.option("--backend", type=click.Choice(["tf", "tflite"]), default="tf")
+@click.option("--max-batch-size", default=32)
+@click.option("--max-batch-wait", default=5.0)
+def replay(
+    sample_ids,
+    fixture,
+    devices,
+    rate,
+    duration,
+    find_max,
+    max_latency,
+    max_devices,
+    backend,
+    max_batch_size,
+    max_batch_wait,
+):
+    """Replay recorded samples through the processor
+
+    Replay samples from the database (by default the first few) or a fixture
+    file as messages from simulated devices, and report the prediction
+    latency, CPU time per message and optionally the maximum number of devices
+    the processor can keep up with.
+    """
+
+    from .bench import load_replay_audio, run_replay
+
+    run_replay(
+        load_replay_audio(sample_ids, fixture),
+        n_devices=devices,
+        rate=rate,
+        duration=duration,
+        find_max=find_max,
+        max_latency=max_latency,
+        max_devices=max_devices,
+        backend=backend,
+        max_batch_size=max_batch_size,
+        max_batch_wait_ms=max_batch_wait,
+    )
+
+
+@bench.command()
+@click.option("--backend", type=click.Choice(["tf", "tflite"]), default="tf")
+@click.option(
+    "--batch-size",
+    "batch_sizes",
+    type=int,
+    multiple=True,
+    default=[1, 8, 32],
+    help="Batch size of the model call, can be given multiple times",
+)
+@click.option("--runs", default=100, help="Number of timed calls")
+def micro(backend, batch_sizes, runs):
+    """Microbenchmark the prediction hot path
+
+    Time computing features from one payload and calling the model in
+    isolation.
+    """
+
+    from .bench import microbenchmark
+
+    microbenchmark(backend, batch_sizes, runs)
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+import click
+
+from .processor import is_format_topic
+
+QUEUE_SIZE = 4
+MAX_MESSAGE_AGE_S = 2.0
+N_WORKERS = 4
+
+
+class DeviceQueue:
+    """Bounded message queue of one device
+
+    When the queue is full, the oldest audio message is dropped to make room
+    for the new one. Interrupts (empty payloads) are kept, as they end the
+    detection of the device.
+    """
+
+    def __init__(self, maxsize):
+        self.messages = collections.deque(maxlen=maxsize)
+        self.gap = False
+
+    def put(self, message):
+        dropped = len(self.messages) == self.messages.maxlen
+        if dropped:
+            self.gap = True
+            for index, (_, _, payload, _) in enumerate(self.messages):
+                if payload:
+                    del self.messages[index]
+                    break
+            # If only interrupts are queued, the oldest one is dropped by the
+            # deque, which is harmless as consecutive interrupts are redundant
+        self.messages.append(message)
+        return dropped
+
+
+class AsyncProcessor:
+    """Asyncio front end for Processor
+
+    The messages are received in the paho network thread and handed over to
+    the event loop, which queues them per device. A device with queued messages
+    has a task computing features from them one at a time in a thread pool, so
+    that the devices are processed concurrently without sharing any state.
+    Messages waiting for longer than the maximum age are dropped instead of
+    processed, so that a burst of traffic can't build up latency.
+    """
+
+    def __init__(self, processor, *, queue_size, max_message_age, n_workers):
+        self._processor = processor
+        self._queue_size = queue_size
+        self._max_message_age = max_message_age
+        self._executor = concurrent.futures.ThreadPoolExecutor(n_workers)
+        self._queues = {}
+        self._loop = None
+        processor.metrics.set_gauge(
+            "queued_messages",
+            lambda: sum(len(queue.messages) for queue in list(self._queues.values())),
+        )
+
+    def init_mqtt_client(self, client):
+        # Only takes over receiving messages from a client already initialized
+        # by the processor
+        client.on_message = self.on_message
+
+    def on_message(self, client, userdata, msg):
+        if not self._processor.accepts(msg.topic):
+            return
+        if is_format_topic(msg.topic):
+            # Only the announced format is updated here. The worker processing
+            # the messages of the device switches the extractor, so that it's
+            # never replaced while in use.
+            self._loop.call_soon_threadsafe(
+                self._processor.set_format, msg.topic, msg.payload
+            )
+            return
+        self._loop.call_soon_threadsafe(
+            self._enqueue, msg.topic, msg.payload, time.monotonic()
+        )
+
+    async def run(self, client):
+        self._loop = asyncio.get_running_loop()
+        client.loop_start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            client.loop_stop()
+            self._executor.shutdown(cancel_futures=True)
+
+    def _enqueue(self, topic, payload, timestamp):
+        device = self._processor.receive(topic, payload)
+        queue = self._queues.get(topic)
+        if queue is None:
+            queue = self._queues[topic] = DeviceQueue(self._queue_size)
+            asyncio.create_task(self._process_device(topic, queue))
+        if queue.put((device, device.format, payload, timestamp)):
+            self._processor.metrics.increment("dropped_messages")
+
+    async def _process_device(self, topic, queue):
+        try:
+            await self._process_messages(topic, queue)
+        finally:
+            del self._queues[topic]
+
+    async def _process_messages(self, topic, queue):
+        while queue.messages:
+            device, format, payload, timestamp = queue.messages.popleft()
+            if queue.gap:
+                # The dropped audio breaks the continuity of the stream
+                self._processor.reset_stream(device)
+                queue.gap = False
+            if payload and time.monotonic() - timestamp > self._max_message_age:
+                self._processor.metrics.increment("dropped_messages")
+                queue.gap = True
+                continue
+            try:
+                await self._loop.run_in_executor(
+                    self._executor,
+                    self._processor.process_samples,
+                    device,
+                    topic,
+                    payload,
+                    timestamp,
+                    format,
+                )
+            except Exception as e:
+                click.echo(f"Failed to process message from {topic}: {e}", err=True)
+
+
+def run_async(processor, client, *, queue_size, max_message_age, n_workers):
+    """Run the processor in an asyncio event loop"""
+    async_processor = AsyncProcessor(
+        processor,
+        queue_size=queue_size,
+        max_message_age=max_message_age,
+        n_workers=n_workers,
+    )
+    async_processor.init_mqtt_client(client)
+    try:
+        asyncio.run(async_processor.run(client))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        processor.stop()
@@ -0,0 +1,359 @@
+import collections
+import heapq
+import itertools
+import multiprocessing
+import queue
+import resource
+import threading
+import time
+import timeit
+import wave
+
+import click
+import numpy as np
+
+from .model import SAMPLING_FREQ, FeatureExtractor, FrameBuffer, to_features
+
+BACKENDS = ["tf", "tflite"]
+N_REPLAYED_SAMPLES = 10
+
+Message = collections.namedtuple("Message", ["topic", "payload"])
+
+
+def make_windows(n_windows, *, seed=0):
+    from .processor import N_FRAMES_FOR_PREDICTION
+
+    rng = np.random.default_rng(seed)
+    windows = []
+    for _ in range(n_windows):
+        extractor = FeatureExtractor()
+        frames = FrameBuffer(N_FRAMES_FOR_PREDICTION)
+        while not frames.is_full():
+            audio = rng.integers(0, 2**16, SAMPLING_FREQ // 2, dtype=np.uint16)
+            frames.push(extractor.push(audio.tobytes()))
+        windows.append(np.array(frames.window()))
+    return np.stack(windows)
+
+
+def _measure_backend(backend, batch_size, n_runs, results):
+    start_time = time.perf_counter()
+    from .inference import predict_batch
+    from .processor import load_model
+
+    model = load_model(backend, max_batch_size=batch_size)
+    load_time = time.perf_counter() - start_time
+
+    windows = make_windows(batch_size)
+    start_time = time.perf_counter()
+    predictions = predict_batch(model, windows)
+    first_call_time = time.perf_counter() - start_time
+
+    call_times = []
+    for _ in range(n_runs):
+        start_time = time.perf_counter()
+        predict_batch(model, windows)
+        call_times.append(time.perf_counter() - start_time)
+
+    results.put(
+        dict(
+            load_time=load_time,
+            first_call_time=first_call_time,
+            call_time=float(np.median(call_times)),
+            # ru_maxrss is in kilobytes on Linux
+            max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            predictions=predictions,
+        )
+    )
+
+
+def _wait_for_result(process, result_queue):
+    # Returns None if the process dies without a result, e.g. when the backend
+    # fails to import or runs out of memory
+    while True:
+        try:
+            return result_queue.get(timeout=1.0)
+        except queue.Empty:
+            if process.exitcode is not None:
+                break
+    # The result may have arrived right before the process exited
+    try:
+        return result_queue.get_nowait()
+    except queue.Empty:
+        return None
+
+
+def compare_backends(batch_size, n_runs):
+    """Compare inference backends"""
+    # Each backend is measured in a fresh interpreter so that the import time
+    # and memory usage of one doesn't affect the other
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for backend in BACKENDS:
+        result_queue = context.Queue()
+        process = context.Process(
+            target=_measure_backend, args=(backend, batch_size, n_runs, result_queue)
+        )
+        process.start()
+        result = _wait_for_result(process, result_queue)
+        process.join()
+        if result is None:
+            click.echo(
+                f"Measuring backend {backend} failed with exit code "
+                f"{process.exitcode}",
+                err=True,
+            )
+        else:
+            results[backend] = result
+    if not results:
+        raise click.ClickException("All backends failed")
+
+    reference_predictions = np.array(next(iter(results.values()))["predictions"])
+    click.echo(
+        f"{'backend':<10}{'load (s)':>10}{'first (ms)':>12}{'call (ms)':>11}"
+        f"{'RSS (MiB)':>11}{'max diff':>10}"
+    )
+    for backend, result in results.items():
+        max_diff = np.max(np.abs(result["predictions"] - reference_predictions))
+        click.echo(
+            f"{backend:<10}{result['load_time']:>10.2f}"
+            f"{1000 * result['first_call_time']:>12.2f}"
+            f"{1000 * result['call_time']:>11.2f}"
+            f"{result['max_rss']:>11.1f}{max_diff:>10}"
+        )
+
+
+def measure_dataset(n_batches):
+    """Measure training dataset construction time and throughput"""
+    from .modeltraining import load_dataset_for_training, make_dataset
+
+    start_time = time.perf_counter()
+    cache, splits = load_dataset_for_training()
+    dataset = make_dataset(cache, splits["train"])
+    click.echo(f"Dataset constructed in {time.perf_counter() - start_time:.2f} s")
+
+    batches = iter(dataset)
+    start_time = time.perf_counter()
+    next(batches)
+    click.echo(f"First batch in {time.perf_counter() - start_time:.2f} s")
+
+    n_examples = 0
+    start_time = time.perf_counter()
+    for features, _ in itertools.islice(batches, n_batches):
+        n_examples += len(features)
+    elapsed_time = time.perf_counter() - start_time
+    click.echo(f"{n_examples / elapsed_time:.0f} examples/s over {n_examples} examples")
+
+
+class LoopbackClient:
+    """In-process stand-in for the MQTT client
+
+    Messages are delivered by calling the processor directly, and published
+    messages are only counted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.n_published = 0
+
+    def subscribe(self, topic):
+        pass
+
+    def will_set(self, topic, payload=None, *args, **kwargs):
+        pass
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        with self._lock:
+            self.n_published += 1
+
+
+def load_replay_audio(sample_ids, fixture):
+    if fixture:
+        if fixture.endswith(".wav"):
+            with wave.open(fixture) as f:
+                if (
+                    f.getsampwidth() != 2
+                    or f.getnchannels() != 1
+                    or f.getframerate() != SAMPLING_FREQ
+                ):
+                    raise click.BadParameter(
+                        f"expected 16-bit mono audio at {SAMPLING_FREQ} Hz",
+                        param_hint="--fixture",
+                    )
+                return f.readframes(f.getnframes())
+        with open(fixture, "rb") as f:
+            return f.read()
+
+    import sqlalchemy as sa
+    from . import db
+
+    if not sample_ids:
+        sample_ids = list(
+            db.engine.execute(
+                sa.select([db.samples.c.id])
+                .where(db.samples.c.complete)
+                .order_by(db.samples.c.id)
+                .limit(N_REPLAYED_SAMPLES)
+            ).scalars()
+        )
+    data = db.load_sample_data(sample_ids)
+    return b"".join(data[id] for id in sample_ids if id in data)
+
+
+def replay(audio, *, n_devices, rate, duration, **processor_options):
+    """Replay audio from simulated devices through a processor
+
+    Each device sends a payload every 1/rate seconds, starting from its own
+    offset in the audio. The messages are delivered from the calling thread,
+    like paho delivers them from its network thread.
+    """
+    from .processor import SAMPLES_PER_PAYLOAD, Processor
+
+    payload_size = 2 * SAMPLES_PER_PAYLOAD
+    payloads = [
+        audio[start : start + payload_size]
+        for start in range(0, len(audio) - payload_size + 1, payload_size)
+    ]
+    if not payloads:
+        raise click.ClickException("Not enough audio to replay")
+
+    processor = Processor(None, True, **processor_options)
+    client = LoopbackClient()
+    processor.init_mqtt_client(client)
+
+    interval = 1 / rate
+    start_time = time.monotonic()
+    start_cpu_time = time.process_time()
+    schedule = [
+        (start_time + device * interval / n_devices, device, 0)
+        for device in range(n_devices)
+    ]
+    n_messages = 0
+    max_lag = 0.0
+    while schedule:
+        send_time, device, n_sent = heapq.heappop(schedule)
+        if send_time - start_time >= duration:
+            continue
+        lag = time.monotonic() - send_time
+        if lag < 0:
+            time.sleep(-lag)
+        max_lag = max(max_lag, lag)
+        payload_index = device * len(payloads) // n_devices + n_sent
+        processor.on_message(
+            client,
+            None,
+            Message(
+                f"lotina/bench{device}/samples",
+                payloads[payload_index % len(payloads)],
+            ),
+        )
+        n_messages += 1
+        heapq.heappush(schedule, (send_time + interval, device, n_sent + 1))
+    processor.stop()
+    elapsed_time = time.monotonic() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+
+    latency = processor.metrics.snapshot()["stages"].get("latency")
+    return dict(
+        n_devices=n_devices,
+        message_rate=n_messages / elapsed_time,
+        cpu_time=cpu_time / n_messages,
+        p50_latency=latency["p50_ms"] / 1000 if latency else float("nan"),
+        p99_latency=latency["p99_ms"] / 1000 if latency else float("nan"),
+        max_lag=max_lag,
+        n_predictions=client.n_published,
+    )
+
+
+def run_replay(
+    audio,
+    *,
+    n_devices,
+    rate,
+    duration,
+    find_max,
+    max_latency,
+    max_devices,
+    **processor_options,
+):
+    """Replay audio and report latency and throughput
+
+    With find_max, the number of devices is doubled until the processor can't
+    keep up, either because the p99 latency exceeds the maximum, or because
+    the messages can't be delivered at the requested rate.
+    """
+    click.echo(
+        f"{'devices':>8}{'msg/s':>9}{'CPU ms/msg':>12}{'p50 ms':>9}{'p99 ms':>9}"
+        f"{'lag ms':>9}{'predictions':>13}"
+    )
+    max_sustainable_devices = None
+    while True:
+        result = replay(
+            audio,
+            n_devices=n_devices,
+            rate=rate,
+            duration=duration,
+            **processor_options,
+        )
+        click.echo(
+            f"{result['n_devices']:>8}{result['message_rate']:>9.1f}"
+            f"{1000 * result['cpu_time']:>12.2f}"
+            f"{1000 * result['p50_latency']:>9.1f}"
+            f"{1000 * result['p99_latency']:>9.1f}"
+            f"{1000 * result['max_lag']:>9.1f}{result['n_predictions']:>13}"
+        )
+        sustainable = (
+            result["p99_latency"] <= max_latency and result["max_lag"] <= 1 / rate
+        )
+        if not find_max or not sustainable:
+            break
+        max_sustainable_devices = n_devices
+        if n_devices >= max_devices:
+            break
+        n_devices = min(2 * n_devices, max_devices)
+    if find_max:
+        click.echo(f"Max sustainable devices: {max_sustainable_devices or 'none'}")
+
+
+def _time_call(function, n_runs):
+    return float(np.median(timeit.repeat(function, number=1, repeat=n_runs)))
+
+
+def microbenchmark(backend, batch_sizes, n_runs):
+    """Time the feature computation and the model call in isolation"""
+    from .inference import predict_batch
+    from .processor import SAMPLES_PER_PAYLOAD, load_model
+
+    rng = np.random.default_rng(0)
+    payload = rng.integers(0, 2**16, SAMPLES_PER_PAYLOAD, dtype=np.uint16).tobytes()
+    extractor = FeatureExtractor()
+    timings = [
+        ("to_features", _time_call(lambda: to_features(payload), n_runs)),
+        ("FeatureExtractor.push", _time_call(lambda: extractor.push(payload), n_runs)),
+    ]
+
+    model = load_model(backend, max_batch_size=max(batch_sizes))
+
+    def call_unfused(windows):
+        # Calls the model with the exact batch size, and reduces the
+        # predictions in numpy
+        return model(windows)
+
+    for batch_size in batch_sizes:
+        windows = make_windows(batch_size)
+        predict_batch(model, windows)
+        predict_batch(call_unfused, windows)
+        timings.append(
+            (
+                f"model, batch size {batch_size}",
+                _time_call(lambda: predict_batch(model, windows), n_runs),
+            )
+        )
+        timings.append(
+            (
+                f"unfused, batch size {batch_size}",
+                _time_call(lambda: predict_batch(call_unfused, windows), n_runs),
+            )
+        )
+
+    for name, timing in timings:
+        click.echo(f"{name:<30}{1000 * timing:>10.3f} ms")
@@ -1,9 +1,14 @@
+import hashlib
 import os
 
 from dotenv import load_dotenv
 import sqlalchemy as sa
 from sqlalchemy.dialects import mysql
 
+from .model import get_duration, get_level
+
+FETCH_BATCH_SIZE = 16
+
 load_dotenv()
 
 engine = sa.create_engine(os.getenv("DATABASE_URL"))
@@ -13,8 +18,193 @@ samples = sa.Table(
     "samples",
     metadata,
     sa.Column("id", sa.Integer, primary_key=True),
-    sa.Column("label", sa.String(63), nullable=False),
+    sa.Column("label", sa.String(63), nullable=False, index=True),
+    sa.Column("data", mysql.LONGBLOB, nullable=False),
+    sa.Column("format", sa.String(31), nullable=False, server_default="pcm16/22050"),
+    # Chunked samples are inserted when their first chunk is written, and
+    # marked complete when the recording ends. Only complete samples should be
+    # used for anything but recording.
+    sa.Column("complete", sa.Boolean, nullable=False, server_default=sa.true()),
+    # Metadata of the sample, so that it can be listed and filtered without
+    # touching the data. Samples recorded before the metadata was introduced
+    # get the columns that can be computed from the data by backfill_metadata()
+    sa.Column("device_id", sa.String(63), index=True),
+    sa.Column("recorded_at", sa.DateTime, index=True),
+    sa.Column("duration", sa.Float),
+    # The level as in get_level(), which for band features is the mean band
+    # rather than the RMS of the audio
+    sa.Column("rms", sa.Float),
+    # SHA-1 of the data as stored (the payloads, not the features computed
+    # from them), for finding duplicate samples
+    sa.Column("data_checksum", sa.String(40), index=True),
+)
+# Long recordings are stored in chunks, in which case the data column of the
+# sample is empty and all of the data is in the chunks
+sample_chunks = sa.Table(
+    "sample_chunks",
+    metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column(
+        "sample_id", sa.Integer, sa.ForeignKey(samples.c.id), nullable=False, index=True
+    ),
+    sa.Column("seq", sa.Integer, nullable=False),
     sa.Column("data", mysql.LONGBLOB, nullable=False),
 )
 
-metadata.create_all(engine)
+
+def add_missing_columns():
+    """Add columns introduced after the tables were created"""
+    inspector = sa.inspect(engine)
+    for table in metadata.sorted_tables:
+        column_names = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in column_names:
+                column_spec = sa.schema.CreateColumn(column).compile(engine)
+                engine.execute(sa.text(f"ALTER TABLE {table.name} ADD {column_spec}"))
+
+
+def add_missing_indexes():
+    """Create indexes introduced after the tables were created"""
+    inspector = sa.inspect(engine)
+    for table in metadata.sorted_tables:
+        index_names = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in index_names:
+                index.create(engine)
+
+
+def migrate_schema():
+    """Create the tables, and the columns and indexes missing from them
+
+    Run explicitly by the migrate command rather than on import, so that
+    processes starting at the same time don't race to change the schema.
+    """
+    metadata.create_all(engine)
+    add_missing_columns()
+    add_missing_indexes()
+
+
+def get_sample_metadata(data, format):
+    """Compute the metadata columns of a sample from its data
+
+    The RMS is the level of the audio as in get_level(), i.e. in the same
+    units as the threshold of the device, or the mean band of band features.
+    """
+    return dict(
+        duration=get_duration(data, format),
+        rms=get_level(data, format) if data else 0.0,
+        data_checksum=hashlib.sha1(data).hexdigest(),
+    )
+
+
+def load_sample_data(ids):
+    """Load the data of the samples, including their chunks
+
+    Returns a dict mapping the sample ids to their data.
+    """
+    data = {
+        id: [sample_data]
+        for id, sample_data in engine.execute(
+            sa.select([samples.c.id, samples.c.data]).where(samples.c.id.in_(ids))
+        )
+    }
+    for sample_id, chunk_data in engine.execute(
+        sa.select([sample_chunks.c.sample_id, sample_chunks.c.data])
+        .where(sample_chunks.c.sample_id.in_(ids))
+        .order_by(sample_chunks.c.sample_id, sample_chunks.c.seq)
+    ):
+        data[sample_id].append(chunk_data)
+    return {id: b"".join(parts) for id, parts in data.items()}
+
+
+def iter_sample_data(ids, batch_size=FETCH_BATCH_SIZE):
+    """Load the data of the samples lazily in batches
+
+    Yields (id, format, data) tuples, so that only one batch of samples is in
+    memory at a time.
+    """
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        batch_ids = ids[start : start + batch_size]
+        formats = {
+            id: format
+            for id, format in engine.execute(
+                sa.select([samples.c.id, samples.c.format]).where(
+                    samples.c.id.in_(batch_ids)
+                )
+            )
+        }
+        for id, data in load_sample_data(batch_ids).items():
+            yield id, formats[id], data
+
+
+def backfill_metadata(batch_size=FETCH_BATCH_SIZE):
+    """Compute the metadata of the complete samples missing it
+
+    The device and the time of recording can't be recovered from the data, so
+    they are left empty. Samples still being recorded get their metadata when
+    they are complete. Returns the number of samples updated.
+    """
+    ids = list(
+        engine.execute(
+            sa.select([samples.c.id]).where(
+                samples.c.data_checksum.is_(None) & samples.c.complete
+            )
+        ).scalars()
+    )
+    for id, format, data in iter_sample_data(ids, batch_size):
+        engine.execute(
+            samples.update()
+            .where(samples.c.id == id)
+            .values(get_sample_metadata(data, format))
+        )
+    return len(ids)
+
+
+def select_samples(*, labels=None, device_ids=None, min_duration=None):
+    """Return a query selecting the metadata of the samples, without the data"""
+    query = sa.select(
+        [
+            samples.c.id,
+            samples.c.label,
+            samples.c.format,
+            samples.c.device_id,
+            samples.c.recorded_at,
+            samples.c.duration,
+            samples.c.rms,
+        ]
+    ).order_by(samples.c.id)
+    if labels:
+        query = query.where(samples.c.label.in_(labels))
+    if device_ids:
+        query = query.where(samples.c.device_id.in_(device_ids))
+    if min_duration is not None:
+        query = query.where(samples.c.duration >= min_duration)
+    return query
+
+
+def get_sample_stats():
+    """Return the number and the total duration of the samples by label
+
+    The mean RMS is only over the audio samples, as the level of band features
+    is in different units.
+    """
+    audio_rms = sa.case(
+        (samples.c.format.startswith("bands"), sa.null()), else_=samples.c.rms
+    )
+    return list(
+        engine.execute(
+            sa.select(
+                [
+                    samples.c.label,
+                    sa.func.count(samples.c.id),
+                    sa.func.sum(samples.c.duration),
+                    sa.func.avg(audio_rms),
+                    sa.func.count(samples.c.id)
+                    - sa.func.count(samples.c.data_checksum),
+                ]
+            )
+            .group_by(samples.c.label)
+            .order_by(samples.c.label)
+        )
+    )
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+
+from dotenv import load_dotenv
+import numpy as np
+
+from . import db
+from .model import (
+    BAND_FRAME_LENGTH,
+    FEATURES_BANDS,
+    FEATURES_SPECTROGRAM,
+    FEATURE_KINDS,
+    N_BANDS,
+    N_SEGMENTS,
+    SAMPLING_FREQ,
+    to_features,
+)
+
+load_dotenv()
+
+
+def get_cache_dir():
+    return pathlib.Path(os.getenv("LOTINA_CACHE_DIR", ".lotina-cache"))
+
+
+def get_parameter_hash(features=FEATURES_SPECTROGRAM, n_segments=N_SEGMENTS):
+    if features == FEATURES_BANDS:
+        parameters = dict(frame_length=BAND_FRAME_LENGTH, n_bands=N_BANDS)
+    else:
+        parameters = dict(sampling_freq=SAMPLING_FREQ, n_segments=n_segments)
+    parameters_json = json.dumps(parameters, sort_keys=True).encode()
+    return hashlib.sha1(parameters_json).hexdigest()[:16]
+
+
+class FeatureCache:
+    """On-disk cache of the features computed from samples
+
+    Features are stored as one .npy file per sample, and loaded memory mapped.
+    The cache directory is keyed by the hash of the feature parameters, so
+    changing them invalidates the cached features of the same kind. With
+    prune=False, the features cached with other parameters are kept, so that
+    several caches of the same kind can be used side by side.
+    """
+
+    def __init__(
+        self,
+        cache_dir=None,
+        features=FEATURES_SPECTROGRAM,
+        *,
+        n_segments=N_SEGMENTS,
+        prune=True,
+    ):
+        self._features = features
+        self._n_segments = n_segments
+        cache_root = pathlib.Path(cache_dir or get_cache_dir()) / "features"
+        features_root = cache_root / features
+        self._path = features_root / get_parameter_hash(features, n_segments)
+        if prune and cache_root.exists():
+            # Spectrograms used to be cached directly under the hash of their
+            # parameters, before there were other kinds of features
+            for path in cache_root.iterdir():
+                if path.name not in FEATURE_KINDS:
+                    shutil.rmtree(path)
+        if prune and features_root.exists():
+            for path in features_root.iterdir():
+                if path != self._path:
+                    shutil.rmtree(path)
+        self._path.mkdir(parents=True, exist_ok=True)
+
+    def update(self, ids):
+        """Compute and store features for the samples not yet in the cache
+
+        Returns the number of samples whose features were computed.
+        """
+        missing_ids = [id for id in ids if not self._get_path(id).exists()]
+        for id, format, data in db.iter_sample_data(missing_ids):
+            self._save(id, to_features(data, format, self._features, self._n_segments))
+        return len(missing_ids)
+
+    def load(self, id):
+        return np.load(self._get_path(id), mmap_mode="r")
+
+    def _get_path(self, id):
+        return self._path / f"{id}.npy"
+
+    def _save(self, id, features):
+        # Write to a temporary file first, so that an interrupted run doesn't
+        # leave truncated files in the cache
+        path = self._get_path(id)
+        temporary_path = path.with_suffix(".tmp.npy")
+        np.save(temporary_path, features.astype(np.float32))
+        os.replace(temporary_path, path)
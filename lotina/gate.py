@@ -0,0 +1,40 @@
+import numpy as np
+
+GATE_SILENT = "silent"
+GATE_UNCHANGED = "unchanged"
+
+
+class SpectralGate:
+    """Cheap check of the latest payload deciding whether the model needs to run
+
+    If the level of the payload (see get_level()) is below the minimum, the
+    window is considered silent. The level of band features received from the
+    device is the mean band rather than the RMS of the audio, so they have a
+    threshold of their own. If the spectrum of the frames computed from
+    the payload differs from the reference (the spectrum the model was last
+    run for) less than the maximum relative flux, the window is considered
+    unchanged. Either check is disabled by a zero threshold.
+    """
+
+    def __init__(self, *, min_level=0.0, min_band_level=0.0, max_flux=0.0):
+        self._min_level = min_level
+        self._min_band_level = min_band_level
+        self._max_flux = max_flux
+
+    def is_enabled(self):
+        return bool(self._min_level or self._min_band_level or self._max_flux)
+
+    def check(self, level, frames, reference, *, band_level=False):
+        """Check the latest payload against the reference spectrum
+
+        Returns a tuple containing GATE_SILENT, GATE_UNCHANGED or None if the
+        model should run, and the spectrum of the frames.
+        """
+        spectrum = frames.mean(axis=0)
+        if level < (self._min_band_level if band_level else self._min_level):
+            return GATE_SILENT, spectrum
+        if self._max_flux and reference is not None:
+            flux = np.abs(spectrum - reference).sum() / max(reference.sum(), 1e-9)
+            if flux < self._max_flux:
+                return GATE_UNCHANGED, spectrum
+        return None, spectrum
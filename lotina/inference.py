@@ -0,0 +1,262 @@
+import collections
+import threading
+import time
+
+import click
+import numpy as np
+
+MAX_BATCH_SIZE = 32
+MAX_BATCH_WAIT_MS = 5.0
+
+
+def get_batch_buckets(max_batch_size):
+    """Return the batch sizes the model is prepared for
+
+    Batches are padded to the next power of two (or the maximum batch size),
+    so that only a few input shapes are ever seen by the model.
+    """
+    buckets = []
+    bucket = 1
+    while bucket < max_batch_size:
+        buckets.append(bucket)
+        bucket *= 2
+    buckets.append(max_batch_size)
+    return buckets
+
+
+def pad_batch(windows, buckets):
+    for bucket in buckets:
+        if bucket >= len(windows):
+            break
+    else:
+        raise ValueError(f"batch of {len(windows)} windows is too large")
+    padding = np.zeros((bucket - len(windows), *windows.shape[1:]), windows.dtype)
+    return np.concatenate((windows, padding))
+
+
+def _scale_predictions(predictions, n_windows):
+    prediction_means = np.asarray(predictions).reshape(n_windows, -1).mean(axis=1)
+    return [int(255 * float(mean)) for mean in prediction_means]
+
+
+def predict_batch(model, windows):
+    """Predict the windows, returning the mean predictions scaled to 0-255
+
+    The model wrappers below do this in their own, faster way. Any other
+    callable is just called with the windows.
+    """
+    if hasattr(model, "predict_batch"):
+        return model.predict_batch(windows)
+    return _scale_predictions(model(windows), len(windows))
+
+
+def warm_up(model, window_shape):
+    """Run the model with dummy input in every batch size it is prepared for
+
+    Tracing the graph and allocating the tensors happens on the first call, so
+    it's better done before the first real prediction.
+    """
+    for batch_size in getattr(model, "batch_buckets", [1]):
+        predict_batch(model, np.zeros((batch_size, *window_shape), dtype=np.float32))
+
+
+class BatchScheduler:
+    """Run the model for windows from several devices in one call
+
+    Windows are submitted from the MQTT network thread and predicted in a
+    background thread, which waits at most the given time for more windows to
+    fill the batch. If a device submits a new window before the previous one
+    was predicted, only the latest window is kept.
+
+    If the start time of the processor is given, the time from it to the first
+    published prediction is reported.
+    """
+
+    def __init__(
+        self,
+        model,
+        publish,
+        *,
+        metrics,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_batch_wait_ms=MAX_BATCH_WAIT_MS,
+        started_at=None,
+    ):
+        self._model = model
+        self._started_at = started_at
+        self._publish = publish
+        self._metrics = metrics
+        self._max_batch_size = max_batch_size
+        self._max_batch_wait = max_batch_wait_ms / 1000
+        self._pending = collections.OrderedDict()
+        self._last_predictions = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        metrics.set_gauge("pending_windows", lambda: len(self._pending))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def submit(self, topic, window, timestamp):
+        """Submit window for prediction
+
+        The timestamp is the monotonic time the message completing the window
+        was received, and is used to measure the end-to-end latency.
+        """
+        with self._condition:
+            if topic in self._pending:
+                self._metrics.increment("superseded_windows")
+            # The window is typically a view to a buffer the caller keeps
+            # writing to, so it's copied before handing it over to the thread
+            self._pending[topic] = (np.array(window), timestamp)
+            self._pending.move_to_end(topic)
+            self._condition.notify()
+
+    def publish_now(self, topic, prediction):
+        """Publish prediction without running the model
+
+        A window of the same topic waiting for prediction is dropped, so that
+        its prediction isn't published after this one.
+        """
+        with self._condition:
+            self._pending.pop(topic, None)
+        self._publish(topic, prediction)
+
+    def last_prediction(self, topic):
+        """Return the latest prediction of the model for the topic, if any"""
+        with self._condition:
+            return self._last_predictions.get(topic)
+
+    def forget(self, topic):
+        with self._condition:
+            self._pending.pop(topic, None)
+            self._last_predictions.pop(topic, None)
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending and not self._stopped:
+                self._condition.wait()
+            deadline = time.monotonic() + self._max_batch_wait
+            while len(self._pending) < self._max_batch_size and not self._stopped:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._condition.wait(timeout)
+            n_batch = min(len(self._pending), self._max_batch_size)
+            return [self._pending.popitem(last=False) for _ in range(n_batch)]
+
+    def _run(self):
+        while batch := self._next_batch():
+            topics = [topic for topic, _ in batch]
+            windows = np.stack([window for _, (window, _) in batch])
+            try:
+                with self._metrics.time("model"):
+                    predictions = predict_batch(self._model, windows)
+            except Exception as e:
+                click.echo(f"Prediction failed: {e}", err=True)
+                continue
+            with self._condition:
+                self._last_predictions.update(zip(topics, predictions))
+            for (topic, (_, timestamp)), prediction in zip(batch, predictions):
+                with self._metrics.time("publish"):
+                    self._publish(topic, prediction)
+                self._metrics.observe("latency", time.monotonic() - timestamp)
+            if self._started_at is not None:
+                startup_time = time.monotonic() - self._started_at
+                self._metrics.observe("startup_to_first_prediction", startup_time)
+                click.echo(f"First prediction {startup_time:.2f} s after startup")
+                self._started_at = None
+
+
+class KerasModel:
+    """Callable wrapper around a Keras model with fixed input signatures
+
+    Calling the wrapper runs the model through a function accepting any batch
+    size, so that the graph is traced once instead of for every batch size.
+
+    predict_batch() runs a graph that also averages and scales the
+    predictions. It is traced up front for windows of the given shape in each
+    batch bucket, so no tracing happens while predicting.
+    """
+
+    def __init__(self, path, window_shape, max_batch_size=MAX_BATCH_SIZE):
+        import tensorflow as tf
+
+        model = tf.keras.models.load_model(path)
+        self._function = tf.function(
+            lambda inputs: model(inputs, training=False),
+            input_signature=[tf.TensorSpec((None, *model.input_shape[1:]), tf.float32)],
+        )
+
+        @tf.function
+        def predict(windows):
+            predictions = model(windows, training=False)
+            predictions = tf.reshape(predictions, (tf.shape(windows)[0], -1))
+            return tf.cast(255 * tf.reduce_mean(predictions, axis=1), tf.int32)
+
+        self.batch_buckets = get_batch_buckets(max_batch_size)
+        self._predict_functions = {
+            bucket: predict.get_concrete_function(
+                tf.TensorSpec((bucket, *window_shape), tf.float32)
+            )
+            for bucket in self.batch_buckets
+        }
+        self._convert = tf.convert_to_tensor
+
+    def __call__(self, inputs):
+        return self._function(np.asarray(inputs, dtype=np.float32)).numpy()
+
+    def predict_batch(self, windows):
+        n_windows = len(windows)
+        windows = pad_batch(np.asarray(windows, dtype=np.float32), self.batch_buckets)
+        predictions = self._predict_functions[len(windows)](self._convert(windows))
+        return predictions.numpy()[:n_windows].tolist()
+
+
+class TFLiteModel:
+    """Callable wrapper around a TensorFlow Lite interpreter
+
+    Uses the standalone tflite_runtime package if available, so that the full
+    TensorFlow doesn't need to be imported (or even installed). A single
+    interpreter is used to keep the memory usage low, and its tensors are only
+    reallocated when the input shape changes. predict_batch() pads the batches
+    to the buckets, so that the shape changes only when the batch size
+    crosses a bucket boundary. The number of threads defaults to the one the
+    interpreter picks.
+    """
+
+    def __init__(self, path, max_batch_size=MAX_BATCH_SIZE, *, n_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        self._interpreter = Interpreter(model_path=path, num_threads=n_threads)
+        self._input_index = self._interpreter.get_input_details()[0]["index"]
+        self._output_index = self._interpreter.get_output_details()[0]["index"]
+        self._input_shape = None
+        self.batch_buckets = get_batch_buckets(max_batch_size)
+
+    def __call__(self, inputs):
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if inputs.shape != self._input_shape:
+            self._interpreter.resize_tensor_input(self._input_index, inputs.shape)
+            self._interpreter.allocate_tensors()
+            self._input_shape = inputs.shape
+        self._interpreter.set_tensor(self._input_index, inputs)
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._output_index)
+
+    def predict_batch(self, windows):
+        n_windows = len(windows)
+        windows = pad_batch(np.asarray(windows, dtype=np.float32), self.batch_buckets)
+        return _scale_predictions(self(windows)[:n_windows], n_windows)
@@ -0,0 +1,163 @@
+import collections
+import contextlib
+import http.server
+import json
+import threading
+import time
+
+import click
+import numpy as np
+
+STATS_TOPIC = "lotina/processor/stats"
+STATS_INTERVAL_S = 60
+N_RECENT_DURATIONS = 1000
+
+
+class Metrics:
+    """Timings and counters of the prediction path
+
+    Durations are recorded per stage, and the percentiles are computed from
+    the most recent ones. All methods may be called from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = collections.defaultdict(
+            lambda: [0, 0.0, collections.deque(maxlen=N_RECENT_DURATIONS)]
+        )
+        self._messages = collections.Counter()
+        self._counters = collections.Counter()
+        self._gauges = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def observe(self, stage, duration):
+        with self._lock:
+            stage_stats = self._stages[stage]
+            stage_stats[0] += 1
+            stage_stats[1] += duration
+            stage_stats[2].append(duration)
+
+    def count_message(self, device_id):
+        with self._lock:
+            self._messages[device_id] += 1
+
+    def increment(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def set_gauge(self, name, get_value):
+        with self._lock:
+            self._gauges[name] = get_value
+
+    def snapshot(self):
+        """Return the current metrics as a JSON serializable dict
+
+        Counts and durations are cumulative since the start of the process.
+        """
+        with self._lock:
+            stages = {
+                stage: dict(
+                    count=count,
+                    total_s=total,
+                    p50_ms=1000 * float(np.percentile(recent, 50)),
+                    p99_ms=1000 * float(np.percentile(recent, 99)),
+                )
+                for stage, (count, total, recent) in self._stages.items()
+            }
+            messages = dict(self._messages)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        return dict(
+            stages=stages,
+            messages=messages,
+            counters=counters,
+            gauges={name: get_value() for name, get_value in gauges.items()},
+        )
+
+
+class StatsPublisher:
+    """Publish the metrics periodically to the stats topic
+
+    In addition to the cumulative snapshot, the message rate of each device
+    over the last interval is published.
+    """
+
+    def __init__(
+        self, metrics, client, *, interval=STATS_INTERVAL_S, topic=STATS_TOPIC
+    ):
+        self._metrics = metrics
+        self._client = client
+        self._interval = interval
+        self._topic = topic
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        previous_messages = {}
+        previous_time = time.monotonic()
+        while not self._stopped.wait(self._interval):
+            snapshot = self._metrics.snapshot()
+            now = time.monotonic()
+            snapshot["message_rates"] = {
+                device_id: (count - previous_messages.get(device_id, 0))
+                / (now - previous_time)
+                for device_id, count in snapshot["messages"].items()
+            }
+            self._client.publish(self._topic, json.dumps(snapshot))
+            previous_messages = snapshot["messages"]
+            previous_time = now
+
+
+def format_prometheus(snapshot):
+    lines = []
+    for stage, stats in snapshot["stages"].items():
+        labels = f'{{stage="{stage}"}}'
+        lines.append(f"lotina_stage_duration_seconds_count{labels} {stats['count']}")
+        lines.append(f"lotina_stage_duration_seconds_sum{labels} {stats['total_s']}")
+        for quantile, key in ((0.5, "p50_ms"), (0.99, "p99_ms")):
+            lines.append(
+                f'lotina_stage_duration_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                f"{stats[key] / 1000}"
+            )
+    for device_id, count in snapshot["messages"].items():
+        lines.append(f'lotina_messages_total{{device="{device_id}"}} {count}')
+    for counter, value in snapshot["counters"].items():
+        lines.append(f"lotina_{counter}_total {value}")
+    for gauge, value in snapshot["gauges"].items():
+        lines.append(f"lotina_{gauge} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port):
+    """Serve the metrics in Prometheus text format in a background thread"""
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = format_prometheus(metrics.snapshot()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    click.echo(f"Serving metrics on port {port}")
+    return server
@@ -3,13 +3,359 @@ import scipy.signal
 
 SAMPLING_FREQ = 22050
 N_SEGMENTS = 1024
+HOP_LENGTH = N_SEGMENTS // 2
+DEFAULT_FORMAT = "pcm16/22050"
+CODECS = ["pcm16", "mulaw", "bands"]
 
+FEATURES_SPECTROGRAM = "spectrogram"
+FEATURES_BANDS = "bands"
+FEATURE_KINDS = [FEATURES_SPECTROGRAM, FEATURES_BANDS]
 
-def get_input_shape():
-    return None, N_SEGMENTS // 2
+# Band features are computed on the device from non-overlapping frames with a
+# fixed point FFT, and summed over equal width bands
+BAND_FRAME_LENGTH = 512
+N_BANDS = 32
+BAND_WINDOW = np.round(
+    32767
+    * (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(BAND_FRAME_LENGTH) / BAND_FRAME_LENGTH))
+).astype(np.int64)
+BAND_TWIDDLES = np.round(
+    32767 * np.cos(2 * np.pi * np.arange(BAND_FRAME_LENGTH // 2) / BAND_FRAME_LENGTH)
+) + 1j * np.round(
+    32767 * np.sin(2 * np.pi * np.arange(BAND_FRAME_LENGTH // 2) / BAND_FRAME_LENGTH)
+)
+BAND_BIT_REVERSAL = np.array(
+    [
+        int(f"{i:0{BAND_FRAME_LENGTH.bit_length() - 1}b}"[::-1], 2)
+        for i in range(BAND_FRAME_LENGTH)
+    ]
+)
 
 
-def to_features(data):
-    samples = np.frombuffer(data, dtype=np.uint16)
-    spectrogram = scipy.signal.stft(samples, SAMPLING_FREQ, nperseg=N_SEGMENTS)[2]
-    return np.transpose(np.abs(spectrogram[1:, :]))
+def format_band_tables():
+    """Return the source of the module holding the band tables for the device
+
+    MicroPython computes in single precision, so the device would round some
+    entries differently. It loads the integer tables from this module instead
+    of computing them.
+    """
+
+    def format_table(name, values):
+        lines = [
+            "    " + ", ".join(str(int(value)) for value in values[i : i + 12]) + ","
+            for i in range(0, len(values), 12)
+        ]
+        return f"{name} = (\n" + "\n".join(lines) + "\n)\n"
+
+    return "\n".join(
+        [
+            "# Generated by python -m lotina band-tables. Do not edit.\n# fmt: off\n",
+            format_table("WINDOW", BAND_WINDOW),
+            format_table("TWIDDLES_COS", BAND_TWIDDLES.real),
+            format_table("TWIDDLES_SIN", BAND_TWIDDLES.imag),
+        ]
+    )
+
+
+def _make_mulaw_table():
+    codes = ~np.arange(256, dtype=np.uint8)
+    exponents = (codes >> 4) & 0x07
+    mantissas = (codes & 0x0F).astype(np.int32)
+    magnitudes = (((mantissas << 3) + 0x84) << exponents) - 0x84
+    return np.where(codes & 0x80, -magnitudes, magnitudes).astype(np.int16)
+
+
+MULAW_TABLE = _make_mulaw_table()
+
+
+def get_input_shape(features=FEATURES_SPECTROGRAM, n_segments=N_SEGMENTS):
+    return None, N_BANDS if features == FEATURES_BANDS else n_segments // 2
+
+
+def get_model_path(features=FEATURES_SPECTROGRAM, backend="tf"):
+    suffix = "-bands" if features == FEATURES_BANDS else ""
+    extension = "tflite" if backend == "tflite" else "tf"
+    return f"lotina{suffix}.{extension}"
+
+
+def parse_format(format):
+    """Parse uplink format of the form <codec>/<sampling frequency>
+
+    Returns the codec and the decimation factor of the audio relative to
+    SAMPLING_FREQ. Raises ValueError if the format is not supported.
+    """
+    codec, _, rate = format.partition("/")
+    if codec not in CODECS:
+        raise ValueError(f"unsupported codec: {codec}")
+    if not rate.isdecimal() or not int(rate):
+        raise ValueError(f"unsupported sampling frequency: {rate}")
+    decimation = SAMPLING_FREQ // int(rate)
+    if decimation * int(rate) != SAMPLING_FREQ or N_SEGMENTS % (2 * decimation):
+        raise ValueError(f"unsupported sampling frequency: {rate}")
+    return codec, decimation
+
+
+def decode_samples(data, format=DEFAULT_FORMAT):
+    """Decode audio in the given uplink format
+
+    Returns the samples as unsigned 16-bit integers (the representation the
+    features have always been computed from) and their decimation factor.
+    """
+    codec, decimation = parse_format(format)
+    if codec == "bands":
+        raise ValueError("band features can't be decoded to audio")
+    if codec == "mulaw":
+        samples = MULAW_TABLE[np.frombuffer(data, dtype=np.uint8)].view(np.uint16)
+    else:
+        samples = np.frombuffer(data, dtype=np.uint16)
+    return samples, decimation
+
+
+def _pad_bins(spectrogram, n_segments=N_SEGMENTS):
+    # Decimated audio has no content above its Nyquist frequency, but the
+    # frequency resolution is kept the same, so the missing bins are zeros
+    n_missing_bins = n_segments // 2 - spectrogram.shape[-1]
+    return np.pad(spectrogram, ((0, 0), (0, n_missing_bins)))
+
+
+def _quantize_band_magnitudes(magnitudes):
+    # Logarithmic scale with eight steps per octave, computed with the same
+    # integer operations as on the device
+    magnitudes = magnitudes.astype(np.int64)
+    lengths = np.zeros_like(magnitudes)
+    nonzero = magnitudes > 0
+    lengths[nonzero] = np.floor(np.log2(magnitudes[nonzero])).astype(np.int64) + 1
+    fractions = np.where(
+        lengths >= 4,
+        magnitudes >> np.maximum(lengths - 4, 0),
+        magnitudes << np.maximum(4 - lengths, 0),
+    )
+    quantized = 8 * (lengths - 1) + (fractions & 7) + 1
+    return np.where(nonzero, quantized, 0).astype(np.uint8)
+
+
+def _fixed_point_fft(frames):
+    # Radix-2 FFT of the frames with Q15 twiddle factors, halving the values at
+    # every stage exactly like the device does
+    n_frames, n = frames.shape
+    real = frames[:, BAND_BIT_REVERSAL]
+    imag = np.zeros_like(real)
+    size = 2
+    while size <= n:
+        half = size // 2
+        wr = BAND_TWIDDLES.real[:: n // size][:half].astype(np.int64)
+        wi = BAND_TWIDDLES.imag[:: n // size][:half].astype(np.int64)
+        real = real.reshape(n_frames, -1, size)
+        imag = imag.reshape(n_frames, -1, size)
+        ar, br = real[:, :, :half], real[:, :, half:]
+        ai, bi = imag[:, :, :half], imag[:, :, half:]
+        tr = (br * wr + bi * wi) >> 15
+        ti = (bi * wr - br * wi) >> 15
+        real = np.concatenate(((ar + tr) >> 1, (ar - tr) >> 1), axis=2)
+        imag = np.concatenate(((ai + ti) >> 1, (ai - ti) >> 1), axis=2)
+        size *= 2
+    return real.reshape(n_frames, n), imag.reshape(n_frames, n)
+
+
+def compute_band_features(samples):
+    """Compute band features from signed 16-bit samples
+
+    This is the server side counterpart of the feature computation done on the
+    device, used to train the band model from recorded audio. It uses the same
+    integer arithmetic, so the features are identical.
+    """
+    n_frames = len(samples) // BAND_FRAME_LENGTH
+    frames = samples[: n_frames * BAND_FRAME_LENGTH].reshape(n_frames, -1)
+    real, imag = _fixed_point_fft((frames.astype(np.int64) * BAND_WINDOW) >> 16)
+    real = np.abs(real[:, 1 : BAND_FRAME_LENGTH // 2 + 1])
+    imag = np.abs(imag[:, 1 : BAND_FRAME_LENGTH // 2 + 1])
+    magnitudes = np.maximum(real, imag) + (np.minimum(real, imag) >> 1)
+    band_magnitudes = magnitudes.reshape(n_frames, N_BANDS, -1).sum(axis=2)
+    return _quantize_band_magnitudes(band_magnitudes)
+
+
+def decode_band_features(data):
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, N_BANDS)
+
+
+def get_level(data, format=DEFAULT_FORMAT):
+    """Return the RMS of the payload as signed 16-bit audio
+
+    The spectrogram is computed from the samples as unsigned, so its magnitude
+    doesn't tell quiet audio from loud. For band features, the mean band is
+    returned instead.
+    """
+    if parse_format(format)[0] == "bands":
+        return float(decode_band_features(data).mean())
+    samples, _ = decode_samples(data, format)
+    return _get_rms(samples)
+
+
+def _get_rms(samples):
+    if not len(samples):
+        return 0.0
+    return float(np.sqrt(np.mean(np.square(samples.view(np.int16), dtype=np.float64))))
+
+
+def get_duration(data, format=DEFAULT_FORMAT):
+    """Return the duration of the payload in seconds"""
+    codec, decimation = parse_format(format)
+    if codec == "bands":
+        n_samples = len(decode_band_features(data)) * BAND_FRAME_LENGTH
+    else:
+        n_samples = len(decode_samples(data, format)[0]) * decimation
+    return n_samples / SAMPLING_FREQ
+
+
+def to_features(
+    data, format=DEFAULT_FORMAT, features=FEATURES_SPECTROGRAM, n_segments=N_SEGMENTS
+):
+    if features == FEATURES_BANDS:
+        if parse_format(format)[0] == "bands":
+            return decode_band_features(data).astype(np.float32)
+        samples, decimation = decode_samples(data, format)
+        if decimation != 1:
+            raise ValueError("band features need full rate audio")
+        return compute_band_features(samples.view(np.int16)).astype(np.float32)
+
+    samples, decimation = decode_samples(data, format)
+    spectrogram = scipy.signal.stft(
+        samples, SAMPLING_FREQ // decimation, nperseg=n_segments // decimation
+    )[2]
+    return _pad_bins(np.transpose(np.abs(spectrogram[1:, :])), n_segments)
+
+
+class FeatureExtractor:
+    """Incremental version of to_features()
+
+    Consecutive payloads pushed to the extractor are treated as one continuous
+    stream. The samples that don't yet fill a whole segment are carried over to
+    the next call, so that only the new spectrogram frames are computed, and
+    they are identical to what to_features() would compute for the
+    concatenated stream.
+
+    level() returns the level of the latest payload (see get_level()) from the
+    samples already decoded by push().
+    """
+
+    band_level = False
+
+    def __init__(self, format=DEFAULT_FORMAT):
+        self.format = format
+        _, decimation = parse_format(format)
+        self._n_segments = N_SEGMENTS // decimation
+        self._hop_length = HOP_LENGTH // decimation
+        window = scipy.signal.get_window("hann", self._n_segments)
+        self._window = window / window.sum()
+        self.reset()
+
+    def reset(self):
+        # Mimic the zero padding scipy.signal.stft() does at the boundary
+        self._tail = np.zeros(self._n_segments - self._hop_length)
+        self._samples = np.zeros(0, dtype=np.uint16)
+
+    def level(self):
+        return _get_rms(self._samples)
+
+    def push(self, data):
+        self._samples, _ = decode_samples(data, self.format)
+        samples = np.concatenate((self._tail, self._samples))
+        n_frames = max(0, (len(samples) - self._n_segments) // self._hop_length + 1)
+        segments = np.lib.stride_tricks.sliding_window_view(samples, self._n_segments)
+        spectrogram = np.fft.rfft(
+            segments[: n_frames * self._hop_length : self._hop_length] * self._window,
+            axis=1,
+        )
+        self._tail = samples[n_frames * self._hop_length :]
+        return _pad_bins(np.abs(spectrogram[:, 1:]))
+
+
+class BandFeatureExtractor:
+    """Incremental version of to_features() for band features
+
+    Band features received from the device are passed through. Audio is split
+    into frames carrying the incomplete frame over to the next call.
+
+    level() returns the level of the latest payload like get_level(), so for
+    band features received from the device it is the mean band, as flagged by
+    band_level, and not the RMS of the audio.
+    """
+
+    def __init__(self, format=DEFAULT_FORMAT):
+        self.format = format
+        codec, decimation = parse_format(format)
+        if codec != "bands" and decimation != 1:
+            raise ValueError("band features need full rate audio")
+        self._decode_bands = codec == "bands"
+        self.band_level = self._decode_bands
+        self.reset()
+
+    def reset(self):
+        self._tail = np.zeros(0, dtype=np.int16)
+        self._decoded = np.zeros(0, dtype=np.uint8)
+
+    def level(self):
+        if not self._decode_bands:
+            return _get_rms(self._decoded)
+        return float(self._decoded.mean()) if len(self._decoded) else 0.0
+
+    def push(self, data):
+        if self._decode_bands:
+            self._decoded = decode_band_features(data)
+            return self._decoded.astype(np.float32)
+        self._decoded, _ = decode_samples(data, self.format)
+        samples = np.concatenate((self._tail, self._decoded.view(np.int16)))
+        n_samples = len(samples) // BAND_FRAME_LENGTH * BAND_FRAME_LENGTH
+        self._tail = samples[n_samples:]
+        return compute_band_features(samples[:n_samples]).astype(np.float32)
+
+
+def can_compute_features(format, features=FEATURES_SPECTROGRAM):
+    codec, decimation = parse_format(format)
+    if features == FEATURES_BANDS:
+        return codec == "bands" or decimation == 1
+    return codec != "bands"
+
+
+def make_feature_extractor(format=DEFAULT_FORMAT, features=FEATURES_SPECTROGRAM):
+    """Create incremental feature extractor for the uplink format
+
+    Raises ValueError if the features can't be computed from the format.
+    """
+    if features == FEATURES_BANDS:
+        return BandFeatureExtractor(format)
+    if parse_format(format)[0] == "bands":
+        raise ValueError("spectrogram can't be computed from band features")
+    return FeatureExtractor(format)
+
+
+class FrameBuffer:
+    """Ring buffer holding the latest feature frames
+
+    Every frame is stored twice, so that the latest frames are always available
+    as a contiguous view without copying.
+    """
+
+    def __init__(self, n_frames, n_features=N_SEGMENTS // 2):
+        self._n_frames = n_frames
+        self._frames = np.zeros((2 * n_frames, n_features), dtype=np.float32)
+        self._position = 0
+        self._size = 0
+
+    def clear(self):
+        self._position = 0
+        self._size = 0
+
+    def is_full(self):
+        return self._size == self._n_frames
+
+    def push(self, frames):
+        frames = frames[-self._n_frames :]
+        indices = (self._position + np.arange(len(frames))) % self._n_frames
+        self._frames[indices] = frames
+        self._frames[indices + self._n_frames] = frames
+        self._position = (self._position + len(frames)) % self._n_frames
+        self._size = min(self._n_frames, self._size + len(frames))
+
+    def window(self):
+        return self._frames[self._position : self._position + self._n_frames]
@@ -1,6 +1,8 @@
 from collections import defaultdict
-import random
-import functools
+import hashlib
+import json
+import shutil
+import time
 
 import click
 import matplotlib.pyplot as plt
@@ -10,72 +12,298 @@ import seaborn as sns
 import sqlalchemy as sa
 import scipy.signal
 import tensorflow.keras as keras
-from tensorflow.keras.utils import timeseries_dataset_from_array
 from tensorflow.data import Dataset
 from tensorflow import reshape
+import tensorflow as tf
 
 from . import db
-from .model import get_input_shape, to_features
+from .featurecache import FeatureCache, get_cache_dir, get_parameter_hash
+from .splits import assign_splits
+from .model import (
+    FEATURES_SPECTROGRAM,
+    N_SEGMENTS,
+    can_compute_features,
+    get_input_shape,
+    get_model_path,
+)
 
 
 SEQUENCE_LENGTH = 10
-SEQUENCE_STRIDE = SEQUENCE_LENGTH // 2
+CONV_FILTERS = (32,)
+DENSE_UNITS = (16,)
+LEARNING_RATE = 0.001
+BATCH_SIZE = 64
+SHUFFLE_BUFFER_SIZE = 1000
+N_REPRESENTATIVE_SAMPLES = 200
+EVALUATE_EPOCHS = 200
+SAVE_EPOCHS = 1000
+EARLY_STOPPING_PATIENCE = 20
 
 
-def load_dataset_for_training():
-    datasets = []
-    rows = list(db.engine.execute(sa.select([db.samples.c.label, db.samples.c.data])))
-    random.shuffle(rows)
-    for label, data in rows:
-        features = timeseries_dataset_from_array(
-            to_features(data),
-            None,
-            SEQUENCE_LENGTH,
-            sequence_stride=SEQUENCE_STRIDE,
-            batch_size=None,
-        )
-        labels = Dataset.from_tensors([label.startswith("tap")]).repeat()
-        datasets.append(Dataset.zip((features, labels)))
-    return (
-        functools.reduce(lambda x, y: x.concatenate(y), datasets)
-        .shuffle(1000)
-        .batch(64)
+def get_n_windows(n_frames, sequence_length=SEQUENCE_LENGTH):
+    return max(0, (n_frames - sequence_length) // (sequence_length // 2) + 1)
+
+
+def make_dataset(
+    cache,
+    rows,
+    *,
+    shuffle=True,
+    features=FEATURES_SPECTROGRAM,
+    sequence_length=SEQUENCE_LENGTH,
+    n_segments=N_SEGMENTS,
+):
+    """Create a dataset streaming windows of features from the cache
+
+    The features of each sample are loaded in parallel and split into
+    sequences of the given length, overlapping by half, in the graph. Only
+    the shapes of the cached features are read up front to compute the
+    cardinality of the dataset. Unshuffled datasets are cached in memory after
+    the first iteration.
+    """
+
+    features_kind = features
+    sequence_stride = sequence_length // 2
+
+    def load_features(id):
+        return np.asarray(cache.load(id), dtype=np.float32)
+
+    def load(id, label):
+        features = tf.numpy_function(load_features, [id], tf.float32)
+        features.set_shape(get_input_shape(features_kind, n_segments))
+        return features, label
+
+    def to_windows(features, label):
+        windows = tf.signal.frame(features, sequence_length, sequence_stride, axis=0)
+        labels = tf.fill((tf.shape(windows)[0], 1), label)
+        return Dataset.from_tensor_slices((windows, labels))
+
+    ids = [id for id, _ in rows]
+    labels = [label.startswith("tap") for _, label in rows]
+    n_windows = sum(get_n_windows(len(cache.load(id)), sequence_length) for id in ids)
+    n_batches = -(-n_windows // BATCH_SIZE)
+    dataset = Dataset.from_tensor_slices((ids, labels))
+    if shuffle:
+        dataset = dataset.shuffle(len(ids))
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE).flat_map(
+        to_windows
+    )
+    if shuffle:
+        dataset = dataset.shuffle(SHUFFLE_BUFFER_SIZE)
+    dataset = dataset.batch(BATCH_SIZE).apply(
+        tf.data.experimental.assert_cardinality(n_batches)
     )
+    if not shuffle:
+        dataset = dataset.cache()
+    else:
+        # The order is random anyway, so the parallel loads may finish in any
+        # order
+        options = tf.data.Options()
+        options.deterministic = False
+        dataset = dataset.with_options(options)
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
 
-def split_dataset(dataset, *, split=0.2):
-    N = int(int(dataset.cardinality()) * split)
-    return dataset.take(N), dataset.skip(N)
-
-
-def train_model(dataset, *, epochs, validation_split=0.2):
-    validate_dataset, train_dataset = split_dataset(dataset, split=validation_split)
-
-    model = keras.Sequential(
-        [
-            keras.layers.Input(get_input_shape()),
-            keras.layers.BatchNormalization(),
-            #            keras.layers.Conv1D(64, (3,), activation="relu"),
-            #            keras.layers.MaxPooling1D(),
-            #            keras.layers.Dropout(0.3),
-            keras.layers.Conv1D(32, (3,), activation="relu"),
-            keras.layers.MaxPooling1D(),
-            #            keras.layers.Dropout(0.3),
-            keras.layers.Dense(16, activation="relu"),
-            #            keras.layers.Dense(8, activation="relu"),
-            keras.layers.Dense(1, activation="sigmoid"),
-        ]
+def load_dataset_for_training(
+    features=FEATURES_SPECTROGRAM, *, n_segments=N_SEGMENTS, prune=True
+):
+    rows = list(
+        db.engine.execute(
+            sa.select([db.samples.c.id, db.samples.c.label, db.samples.c.format]).where(
+                db.samples.c.complete
+            )
+        )
     )
+    # Splits are assigned over all samples, so that they don't depend on which
+    # features are trained on
+    splits = assign_splits([(id, label) for id, label, _ in rows])
+    ids = {id for id, _, format in rows if can_compute_features(format, features)}
+    splits = {
+        split: [(id, label) for id, label in split_rows if id in ids]
+        for split, split_rows in splits.items()
+    }
+    cache = FeatureCache(features=features, n_segments=n_segments, prune=prune)
+    n_computed = cache.update(sorted(ids))
+    click.echo(f"Computed features for {n_computed} new samples")
+    return cache, splits
+
+
+class EpochTimer(keras.callbacks.Callback):
+    """Report the wall time of the epochs when the training ends"""
+
+    def on_train_begin(self, logs=None):
+        self.epoch_times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_times.append(time.perf_counter() - self._epoch_start)
+
+    def on_train_end(self, logs=None):
+        if self.epoch_times:
+            click.echo(
+                f"Trained {len(self.epoch_times)} epochs in "
+                f"{sum(self.epoch_times):.1f} s, "
+                f"{np.mean(self.epoch_times):.2f} s per epoch "
+                f"(first {self.epoch_times[0]:.2f} s, "
+                f"median {np.median(self.epoch_times):.2f} s)"
+            )
+
+
+class EarlyStopping(keras.callbacks.EarlyStopping):
+    """EarlyStopping that keeps its state in the backup directory
+
+    BackupAndRestore only restores the model and the epoch, so without the
+    saved state a resumed training would start waiting from zero and lose the
+    best weights seen before the interruption.
+    """
+
+    def __init__(self, backup_dir=None, **kwargs):
+        super().__init__(**kwargs)
+        self._state_path = backup_dir and backup_dir / "early_stopping.npz"
+
+    def on_train_begin(self, logs=None):
+        super().on_train_begin(logs)
+        if not self._state_path or not self._state_path.exists():
+            return
+        with np.load(self._state_path) as state:
+            self.wait = int(state["wait"])
+            self.best = float(state["best"])
+            self.best_epoch = int(state["best_epoch"])
+            n_weights = int(state["n_weights"])
+            if n_weights:
+                self.best_weights = [state[f"weight_{i}"] for i in range(n_weights)]
+
+    def on_epoch_end(self, epoch, logs=None):
+        super().on_epoch_end(epoch, logs)
+        if not self._state_path:
+            return
+        weights = self.best_weights or []
+        self._state_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that an interruption can't leave
+        # a truncated state behind
+        temp_path = self._state_path.with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            np.savez(
+                f,
+                wait=self.wait,
+                best=self.best,
+                best_epoch=getattr(self, "best_epoch", 0),
+                n_weights=len(weights),
+                **{f"weight_{i}": weight for i, weight in enumerate(weights)},
+            )
+        temp_path.replace(self._state_path)
+
+    def on_train_end(self, logs=None):
+        super().on_train_end(logs)
+        if self._state_path:
+            self._state_path.unlink(missing_ok=True)
+
+
+def get_training_key(splits, **parameters):
+    """Return a hash of the split samples and the parameters of a training"""
+    splits = {split: sorted(rows) for split, rows in splits.items()}
+    key_json = json.dumps(dict(parameters, splits=splits), sort_keys=True).encode()
+    return hashlib.sha1(key_json).hexdigest()[:16]
+
+
+def get_checkpoint_dir(name, key=None):
+    """Return the directory the state of a training is backed up to
+
+    A backup made for another key (see get_training_key()) is deleted, so that
+    a training only resumes from a backup of the same samples and parameters.
+    """
+    directory = get_cache_dir() / "checkpoints" / name
+    if key is not None:
+        key_path = directory / "key"
+        if not key_path.exists() or key_path.read_text() != key:
+            shutil.rmtree(directory, ignore_errors=True)
+            directory.mkdir(parents=True)
+            key_path.write_text(key)
+    return directory
+
+
+def build_model(
+    features=FEATURES_SPECTROGRAM,
+    *,
+    n_segments=N_SEGMENTS,
+    conv_filters=CONV_FILTERS,
+    dense_units=DENSE_UNITS,
+    dropout=0.0,
+):
+    """Build the classifier
+
+    Each number of filters adds a convolution followed by max pooling, and
+    each number of units a dense layer before the output.
+    """
+    layers = [
+        keras.layers.Input(get_input_shape(features, n_segments)),
+        keras.layers.BatchNormalization(),
+    ]
+    for filters in conv_filters:
+        layers.append(keras.layers.Conv1D(filters, (3,), activation="relu"))
+        layers.append(keras.layers.MaxPooling1D())
+        if dropout:
+            layers.append(keras.layers.Dropout(dropout))
+    for units in dense_units:
+        layers.append(keras.layers.Dense(units, activation="relu"))
+    layers.append(keras.layers.Dense(1, activation="sigmoid"))
+    return keras.Sequential(layers)
+
+
+def train_model(
+    train_dataset,
+    validation_dataset,
+    *,
+    epochs,
+    features=FEATURES_SPECTROGRAM,
+    checkpoint_dir=None,
+    patience=EARLY_STOPPING_PATIENCE,
+    jit_compile=False,
+    learning_rate=LEARNING_RATE,
+    verbose="auto",
+    **model_options,
+):
+    """Train the model
+
+    Training stops early when the validation loss (or the training loss,
+    without validation data) hasn't improved for the given number of epochs,
+    and the best weights are restored. With a checkpoint directory, the state
+    is backed up after every epoch, including the state of the early stopping,
+    and an interrupted training resumes from the backup. The rest of the
+    options are passed to build_model().
+    """
+    model = build_model(features, **model_options)
     model.compile(
-        loss="binary_crossentropy", optimizer="adam", metrics=["binary_accuracy"]
+        loss="binary_crossentropy",
+        optimizer=keras.optimizers.Adam(learning_rate),
+        metrics=["binary_accuracy"],
+        jit_compile=jit_compile,
     )
+    callbacks = [EpochTimer()]
+    if patience:
+        callbacks.append(
+            EarlyStopping(
+                checkpoint_dir,
+                monitor="val_loss" if validation_dataset else "loss",
+                patience=patience,
+                restore_best_weights=True,
+                verbose=1,
+            )
+        )
+    if checkpoint_dir:
+        callbacks.append(keras.callbacks.BackupAndRestore(str(checkpoint_dir)))
     history = model.fit(
         train_dataset,
         epochs=epochs,
-        validation_data=validate_dataset,
+        validation_data=validation_dataset,
+        callbacks=callbacks,
+        verbose=verbose,
     )
 
-    model.summary()
+    if verbose:
+        model.summary()
 
     return model, history
 
@@ -90,16 +318,85 @@ def plot_loss(history):
     plt.show()
 
 
-def train(evaluate, save):
+def export_tflite(model, dataset, path, *, quantize):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize:
+        # Quantize weights and activations to int8, but keep float inputs and
+        # outputs so that the model is a drop-in replacement
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: (
+            [reshape(features, (1, *features.shape))]
+            for features, _ in dataset.unbatch().take(N_REPRESENTATIVE_SAMPLES)
+        )
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+
+
+def train(
+    evaluate,
+    save,
+    quantize,
+    features=FEATURES_SPECTROGRAM,
+    *,
+    patience=EARLY_STOPPING_PATIENCE,
+    resume=True,
+    jit_compile=False,
+    n_threads=None,
+):
     """Train model from audio samples"""
-    dataset = load_dataset_for_training()
+    if n_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+    if not resume:
+        shutil.rmtree(get_checkpoint_dir(""), ignore_errors=True)
+
+    cache, splits = load_dataset_for_training(features)
+    parameters = dict(
+        features=features,
+        features_hash=get_parameter_hash(features),
+        sequence_length=SEQUENCE_LENGTH,
+        conv_filters=CONV_FILTERS,
+        dense_units=DENSE_UNITS,
+        learning_rate=LEARNING_RATE,
+        patience=patience,
+    )
     if evaluate:
-        test_dataset, train_dataset = split_dataset(dataset)
-        model, history = train_model(train_dataset, epochs=200)
+        model, history = train_model(
+            make_dataset(cache, splits["train"], features=features),
+            make_dataset(cache, splits["validation"], shuffle=False, features=features),
+            epochs=EVALUATE_EPOCHS,
+            features=features,
+            checkpoint_dir=get_checkpoint_dir(
+                f"{features}-evaluate",
+                get_training_key(splits, epochs=EVALUATE_EPOCHS, **parameters),
+            ),
+            patience=patience,
+            jit_compile=jit_compile,
+        )
         plot_loss(history)
-        test_results = model.evaluate(test_dataset, return_dict=True)
+        test_results = model.evaluate(
+            make_dataset(cache, splits["test"], shuffle=False, features=features),
+            return_dict=True,
+        )
         click.echo(f"Error on test set: {test_results}")
 
     if save:
-        model, _ = train_model(dataset, epochs=1000, validation_split=0.0)
-        model.save("lotina.tf")
+        dataset = make_dataset(
+            cache, [row for rows in splits.values() for row in rows], features=features
+        )
+        model, _ = train_model(
+            dataset,
+            None,
+            epochs=SAVE_EPOCHS,
+            features=features,
+            checkpoint_dir=get_checkpoint_dir(
+                f"{features}-save",
+                get_training_key(splits, epochs=SAVE_EPOCHS, **parameters),
+            ),
+            patience=patience,
+            jit_compile=jit_compile,
+        )
+        model.save(get_model_path(features))
+        export_tflite(
+            model, dataset, get_model_path(features, "tflite"), quantize=quantize
+        )
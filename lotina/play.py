@@ -5,28 +5,44 @@ import sqlalchemy as sa
 import pyaudio
 
 from . import db
+from .model import SAMPLING_FREQ, decode_samples, parse_format
 
 
 def get_sample(id):
-    return db.engine.execute(
-        sa.select([db.samples.c.label, db.samples.c.data]).where(db.samples.c.id == id)
+    label, format = db.engine.execute(
+        sa.select([db.samples.c.label, db.samples.c.format]).where(
+            db.samples.c.id == id
+        )
     ).one()
+    return label, format, db.load_sample_data([id])[id]
 
 
-def play_sample(data):
+def play_sample(data, format):
+    samples, decimation = decode_samples(data, format)
+
     p = pyaudio.PyAudio()
 
-    stream = p.open(format=pyaudio.paInt16, channels=1, rate=22050, output=True)
+    stream = p.open(
+        format=pyaudio.paInt16,
+        channels=1,
+        rate=SAMPLING_FREQ // decimation,
+        output=True,
+    )
 
     with contextlib.closing(stream):
-        stream.write(data)
+        stream.write(samples.tobytes())
 
 
 def play(id):
     """Play sample"""
-    sample = get_sample(id)
+    label, format, data = get_sample(id)
+    if parse_format(format)[0] == "bands":
+        raise click.ClickException(
+            f"Sample {id} contains band features computed on the device, not audio"
+        )
     click.echo(f"Sample {id}")
-    click.echo(f"Label: {sample.label}")
+    click.echo(f"Label: {label}")
+    click.echo(f"Format: {format}")
     click.echo("Playing...")
 
-    play_sample(sample.data)
+    play_sample(data, format)
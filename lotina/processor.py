@@ -1,78 +1,396 @@
+import collections
 import os
 import sys
+import time
 
 import click
 from dotenv import load_dotenv
-import numpy as np
 import paho.mqtt.client as mqtt
 
-from .model import to_features
+from .gate import GATE_SILENT, GATE_UNCHANGED, SpectralGate
+from .inference import MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, BatchScheduler, warm_up
+from .metrics import STATS_TOPIC, Metrics, StatsPublisher, serve_metrics
+from .model import (
+    DEFAULT_FORMAT,
+    FEATURES_SPECTROGRAM,
+    HOP_LENGTH,
+    FrameBuffer,
+    get_input_shape,
+    get_model_path,
+    make_feature_extractor,
+)
+from .sharding import get_shard, run_sharded
 
 TOPIC_SUB = "lotina/+/samples"
+TOPIC_FORMAT = "lotina/+/format"
+AVAILABILITY_TOPIC = "lotina/processor/availability"
+STATE_ONLINE = "online"
+STATE_OFFLINE = "offline"
+# Sent by the device before samples that don't continue the previous ones,
+# e.g. when it skips audio to save power. Unlike the empty payload, it doesn't
+# mean that the sound stopped.
+GAP_PAYLOAD = b"gap"
 N_SAMPLES_FOR_PREDICTION = 3
+SAMPLES_PER_PAYLOAD = 8192
+N_FRAMES_FOR_PREDICTION = N_SAMPLES_FOR_PREDICTION * SAMPLES_PER_PAYLOAD // HOP_LENGTH
+MAX_DEVICES = 256
+DEVICE_IDLE_TIMEOUT_S = 600
 
 load_dotenv()
 
 
-def load_model():
-    import tensorflow.keras as keras
+def get_window_shape(features=FEATURES_SPECTROGRAM):
+    return N_FRAMES_FOR_PREDICTION, get_input_shape(features)[1]
 
-    return keras.models.load_model("lotina.tf")
+
+def load_model(
+    backend="tf", features=FEATURES_SPECTROGRAM, max_batch_size=MAX_BATCH_SIZE
+):
+    path = get_model_path(features, backend)
+    if backend == "tflite":
+        from .inference import TFLiteModel
+
+        return TFLiteModel(path, max_batch_size)
+
+    from .inference import KerasModel
+
+    return KerasModel(path, get_window_shape(features), max_batch_size)
+
+
+def get_device_id(topic):
+    return topic.split("/")[1]
+
+
+def get_prediction_topic(device_id):
+    return f"lotina/{device_id}/prediction"
+
+
+def is_format_topic(topic):
+    return topic.endswith("/format")
+
+
+class DeviceState:
+    def __init__(self, extractor, features):
+        self.extractor = extractor
+        # The format last announced by the device. The extractor is switched
+        # to it by process_samples(), in order with the messages.
+        self.format = extractor.format
+        self.frames = FrameBuffer(*get_window_shape(features))
+        self.last_seen = time.monotonic()
+        # Spectrum of the latest frames the model was last run for
+        self.gate_reference = None
 
 
 class Processor:
-    def __init__(self, label, classify):
+    def __init__(
+        self,
+        label,
+        classify,
+        *,
+        backend="tf",
+        features=FEATURES_SPECTROGRAM,
+        max_devices=MAX_DEVICES,
+        device_idle_timeout=DEVICE_IDLE_TIMEOUT_S,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_batch_wait_ms=MAX_BATCH_WAIT_MS,
+        track=False,
+        shard=None,
+        gate=None,
+    ):
         self._label = label
-        self._model = load_model() if classify else None
-        self._data = bytearray()
-        self._samples = []
+        self._shard = shard
+        self._started_at = time.monotonic()
+        self.metrics = Metrics()
+        self._model = None
+        if classify:
+            with self.metrics.time("model_load"):
+                self._model = load_model(backend, features, max_batch_size)
+            with self.metrics.time("warm_up"):
+                warm_up(self._model, get_window_shape(features))
+            stages = self.metrics.snapshot()["stages"]
+            click.echo(
+                f"Model loaded in {stages['model_load']['total_s']:.2f} s, "
+                f"warmed up in {stages['warm_up']['total_s']:.2f} s"
+            )
+        self._features = features
+        self._gate = gate if gate and gate.is_enabled() else None
+        self._max_devices = max_devices
+        self._device_idle_timeout = device_idle_timeout
+        self._max_batch_size = max_batch_size
+        self._max_batch_wait_ms = max_batch_wait_ms
+        self._devices = collections.OrderedDict()
+        # The devices publish their uplink format as a retained message, so it
+        # is remembered even after the device itself is evicted
+        self._formats = {}
+        self._scheduler = None
+        self._track = track
+        self._tracker = None
+        self._availability_topic = AVAILABILITY_TOPIC
+        if shard is not None:
+            self._availability_topic = f"{AVAILABILITY_TOPIC}/{shard[0]}"
+        self.metrics.set_gauge("devices", lambda: len(self._devices))
+        self._recorder = None
+        if label:
+            from .recorder import Recorder
+
+            self._recorder = Recorder(label)
+            self._recorder.start()
 
     def init_mqtt_client(self, client):
         client.on_connect = self.on_connect
         client.on_message = self.on_message
+        client.will_set(self._availability_topic, STATE_OFFLINE, qos=1, retain=True)
+        if self._model:
+            publish = client.publish
+            if self._track:
+                from .tracker import DetectionTracker
+
+                self._tracker = DetectionTracker(client.publish, metrics=self.metrics)
+                self._tracker.start()
+                publish = self._tracker.update
+            self._scheduler = BatchScheduler(
+                self._model,
+                publish,
+                metrics=self.metrics,
+                max_batch_size=self._max_batch_size,
+                max_batch_wait_ms=self._max_batch_wait_ms,
+                started_at=self._started_at,
+            )
+            self._scheduler.start()
+
+    def stop(self):
+        if self._scheduler:
+            self._scheduler.stop()
+        if self._tracker:
+            self._tracker.stop()
+        if self._recorder:
+            self._recorder.stop()
 
     def on_connect(self, client, userdata, flags, rc):
         click.echo(f"Connected with result code: {rc}")
-        client.subscribe(TOPIC_SUB)
+        client.subscribe([(TOPIC_SUB, 0), (TOPIC_FORMAT, 0)])
+        # The model has been warmed up before connecting, so the processor is
+        # ready as soon as it's connected
+        client.publish(self._availability_topic, STATE_ONLINE, qos=1, retain=True)
+
+    def accepts(self, topic):
+        """Tell whether the device publishing to the topic belongs to the shard"""
+        if self._shard is None:
+            return True
+        index, n_shards = self._shard
+        return get_shard(get_device_id(topic), n_shards) == index
 
     def on_message(self, client, userdata, msg):
-        if self._label:
-            self._data += msg.payload
-        prediction = None
-        if not msg.payload:
-            self._samples.clear()
-        elif self._model:
-            self._samples.append(to_features(msg.payload))
-            if len(self._samples) >= N_SAMPLES_FOR_PREDICTION:
-                prediction = self._make_prediction()
-                self._samples.pop(0)
-        if prediction is not None:
-            prediction_topic = msg.topic.replace("/samples", "/prediction")
-            client.publish(prediction_topic, prediction)
-
-    def save_sample(self):
-        if self._label:
-            from sqlalchemy import insert
-            from . import db
+        if not self.accepts(msg.topic):
+            return
+        if is_format_topic(msg.topic):
+            self.set_format(msg.topic, msg.payload)
+            return
+        timestamp = time.monotonic()
+        device = self.receive(msg.topic, msg.payload)
+        self.process_samples(device, msg.topic, msg.payload, timestamp)
 
-            click.echo(
-                f"Saving sample, label {self._label}, sample size {len(self._data)}"
+    def set_format(self, topic, payload):
+        """Set the uplink format of the device publishing to the format topic"""
+        device_id = get_device_id(topic)
+        try:
+            format = payload.decode() or DEFAULT_FORMAT
+            make_feature_extractor(format, self._features)
+        except ValueError as e:
+            # Also catches UnicodeDecodeError. The format is retained, so an
+            # exception here would crash the processor again on every restart
+            click.echo(f"Ignoring format of device {device_id}: {e}", err=True)
+            return
+        self._formats[device_id] = format
+        device = self._devices.get(device_id)
+        if device and device.format != format:
+            click.echo(f"Device {device_id} uses format {format}")
+            device.format = format
+            if self._recorder:
+                self._recorder.finish(device_id)
+
+    def receive(self, topic, payload):
+        """Look up the device sending the message, and record the payload"""
+        device_id = get_device_id(topic)
+        device = self._get_device(device_id)
+        self.metrics.count_message(device_id)
+        if self._recorder:
+            if payload == GAP_PAYLOAD:
+                # A sample is an uninterrupted stretch of audio
+                self._recorder.finish(device_id)
+            else:
+                self._recorder.record(device_id, payload, device.format)
+        return device
+
+    def process_samples(self, device, topic, payload, timestamp, format=None):
+        """Compute features from the payload, and submit the prediction window
+
+        Unlike receive(), this may be called from a worker thread, as long as
+        the messages from one device are processed one at a time and in order.
+        The timestamp is the monotonic time the message was received, and the
+        format the format of the device when it was received (by default the
+        current one).
+        """
+        format = format or device.format
+        if format != device.extractor.format:
+            device.extractor = make_feature_extractor(format, self._features)
+            self.reset_stream(device)
+        if payload == GAP_PAYLOAD:
+            self.reset_stream(device)
+        elif not payload:
+            self.reset_stream(device)
+            if self._tracker:
+                self._tracker.interrupt(get_device_id(topic))
+        elif self._scheduler:
+            with self.metrics.time("features"):
+                frames = device.extractor.push(payload)
+                device.frames.push(frames)
+            if device.frames.is_full():
+                prediction_topic = get_prediction_topic(get_device_id(topic))
+                if not self._gate_window(device, prediction_topic, frames):
+                    self._scheduler.submit(
+                        prediction_topic, device.frames.window(), timestamp
+                    )
+
+    def reset_stream(self, device):
+        """Start the stream of the device over after a gap in its audio
+
+        Clears the carried over samples, the frames and the gate reference,
+        so that no frame or prediction window spans the gap. Like
+        process_samples(), this must not run concurrently with it for the same
+        device.
+        """
+        device.extractor.reset()
+        device.frames.clear()
+        device.gate_reference = None
+
+    def _gate_window(self, device, prediction_topic, frames):
+        # Publish the prediction without running the model if the gate allows,
+        # and tell whether it did
+        if not self._gate or not len(frames):
+            return False
+        with self.metrics.time("gate"):
+            decision, spectrum = self._gate.check(
+                device.extractor.level(),
+                frames,
+                device.gate_reference,
+                band_level=device.extractor.band_level,
             )
-            db.engine.execute(
-                insert(db.samples).values(label=self._label, data=self._data)
+        prediction = None
+        if decision == GATE_SILENT:
+            prediction = 0
+        elif decision == GATE_UNCHANGED:
+            prediction = self._scheduler.last_prediction(prediction_topic)
+        if prediction is None:
+            device.gate_reference = spectrum
+            return False
+        self.metrics.increment(f"gated_{decision}")
+        self._scheduler.publish_now(prediction_topic, prediction)
+        return True
+
+    def _get_device(self, device_id):
+        now = time.monotonic()
+        device = self._devices.pop(device_id, None)
+        self._evict_devices(now)
+        if device is None:
+            extractor = make_feature_extractor(
+                self._formats.get(device_id, DEFAULT_FORMAT), self._features
             )
+            device = DeviceState(extractor, self._features)
+        device.last_seen = now
+        self._devices[device_id] = device
+        return device
 
-    def _make_prediction(self):
-        from tensorflow.math import reduce_mean
+    def _evict_devices(self, now):
+        # Devices are kept in the order they were last seen, so the idle ones
+        # are always at the front of the table
+        while self._devices:
+            device_id, device = next(iter(self._devices.items()))
+            if (
+                len(self._devices) < self._max_devices
+                and now - device.last_seen < self._device_idle_timeout
+            ):
+                break
+            click.echo(f"Evicting device {device_id}")
+            self.metrics.increment("evicted_devices")
+            del self._devices[device_id]
+            if self._scheduler:
+                self._scheduler.forget(get_prediction_topic(device_id))
+            if self._tracker:
+                self._tracker.forget(device_id)
+            if self._recorder:
+                self._recorder.finish(device_id)
 
-        prediction = self._model(np.stack(self._samples))
-        prediction_mean = reduce_mean(prediction)
-        return int(255 * float(prediction_mean))
 
+def process(
+    label,
+    classify,
+    *,
+    backend,
+    features,
+    max_devices,
+    device_idle_timeout,
+    max_batch_size,
+    max_batch_wait_ms,
+    track,
+    asyncio_mode,
+    queue_size,
+    max_message_age,
+    n_workers,
+    stats_interval,
+    metrics_port,
+    n_shards=1,
+    shard=None,
+    gate_min_level=0.0,
+    gate_min_band_level=0.0,
+    gate_max_flux=0.0,
+):
+    """MQTT message processor
 
-def process(label, classify):
-    """MQTT message processor"""
-    recorder = Processor(label, classify)
+    With several shards, a supervisor runs each shard in its own process.
+    """
+    if n_shards > 1:
+        run_sharded(
+            process,
+            n_shards,
+            label,
+            classify,
+            backend=backend,
+            features=features,
+            max_devices=max_devices,
+            device_idle_timeout=device_idle_timeout,
+            max_batch_size=max_batch_size,
+            max_batch_wait_ms=max_batch_wait_ms,
+            track=track,
+            asyncio_mode=asyncio_mode,
+            queue_size=queue_size,
+            max_message_age=max_message_age,
+            n_workers=n_workers,
+            stats_interval=stats_interval,
+            metrics_port=metrics_port,
+            gate_min_level=gate_min_level,
+            gate_min_band_level=gate_min_band_level,
+            gate_max_flux=gate_max_flux,
+        )
+        return
+
+    recorder = Processor(
+        label,
+        classify,
+        backend=backend,
+        features=features,
+        max_devices=max_devices,
+        device_idle_timeout=device_idle_timeout,
+        max_batch_size=max_batch_size,
+        max_batch_wait_ms=max_batch_wait_ms,
+        track=track,
+        shard=shard,
+        gate=SpectralGate(
+            min_level=gate_min_level,
+            min_band_level=gate_min_band_level,
+            max_flux=gate_max_flux,
+        ),
+    )
 
     client = mqtt.Client()
     recorder.init_mqtt_client(client)
@@ -80,7 +398,31 @@ def process(label, classify):
     client.username_pw_set(os.getenv("MQTT_USER"), os.getenv("MQTT_PASSWD"))
     client.connect(os.getenv("MQTT_BROKER"))
 
+    stats_topic = STATS_TOPIC
+    if shard is not None:
+        stats_topic = f"{STATS_TOPIC}/{shard[0]}"
+        if metrics_port:
+            metrics_port += shard[0]
+    if stats_interval:
+        StatsPublisher(
+            recorder.metrics, client, interval=stats_interval, topic=stats_topic
+        ).start()
+    if metrics_port:
+        serve_metrics(recorder.metrics, metrics_port)
+
+    if asyncio_mode:
+        from .aioprocessor import run_async
+
+        run_async(
+            recorder,
+            client,
+            queue_size=queue_size,
+            max_message_age=max_message_age,
+            n_workers=n_workers,
+        )
+        return
+
     try:
         client.loop_forever()
     except KeyboardInterrupt:
-        recorder.save_sample()
+        recorder.stop()
@@ -0,0 +1,195 @@
+import datetime
+import hashlib
+import math
+import queue
+import threading
+
+import click
+import sqlalchemy as sa
+
+from . import db
+from .model import get_duration, get_level, parse_format
+
+CHUNK_SIZE = 4 * 1024 * 1024
+WRITE_BATCH_SIZE = 32
+
+
+class Segment:
+    """Uninterrupted piece of audio recorded from one device"""
+
+    def __init__(self, device_id, format):
+        self.device_id = device_id
+        self.format = format
+        self.data = bytearray()
+        self.recorded_at = datetime.datetime.utcnow()
+        # Only accessed by the writer thread
+        self.sample_id = None
+        self.n_chunks = 0
+        self.data_checksum = hashlib.sha1()
+        self.duration = 0.0
+        self.level_sum = 0.0
+
+    def update_metadata(self, data):
+        """Accumulate the metadata of a chunked sample
+
+        The level of the chunks is combined so that it equals get_level() of
+        the whole sample: the RMS of audio is averaged as squares, and the mean
+        band of band features as is.
+        """
+        duration = get_duration(data, self.format)
+        level = get_level(data, self.format)
+        self.data_checksum.update(data)
+        self.duration += duration
+        self.level_sum += (level if self._is_bands() else level ** 2) * duration
+
+    def get_metadata(self):
+        level = self.level_sum / self.duration if self.duration else 0.0
+        return dict(
+            duration=self.duration,
+            rms=level if self._is_bands() else math.sqrt(level),
+            data_checksum=self.data_checksum.hexdigest(),
+        )
+
+    def _is_bands(self):
+        return parse_format(self.format)[0] == "bands"
+
+
+class SampleWriter:
+    """Write recorded segments to the database in a background thread
+
+    Segments short enough to fit in one chunk are inserted as samples in
+    batches. Longer segments get their sample row when the first chunk is
+    written, and the rest of the data is appended as chunks, so the recorder
+    never needs to hold more than one chunk per device in memory. Until the
+    segment finishes, the sample is marked incomplete. The metadata
+    of a chunked sample is accumulated chunk by chunk, and stored when the
+    segment finishes.
+    """
+
+    def __init__(self, label):
+        self._label = label
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def write_chunk(self, segment, data):
+        self._queue.put((segment, bytes(data), False))
+
+    def finish(self, segment, data):
+        self._queue.put((segment, bytes(data), True))
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            operations = [self._queue.get()]
+            while len(operations) < WRITE_BATCH_SIZE and not self._queue.empty():
+                operations.append(self._queue.get())
+            if operations[-1] is None:
+                operations.pop()
+                stopped = True
+            try:
+                self._write(operations)
+            except Exception as e:
+                click.echo(f"Failed to save samples: {e}", err=True)
+
+    def _write(self, operations):
+        new_samples = []
+        for segment, data, finished in operations:
+            if finished and segment.sample_id is None:
+                if data:
+                    click.echo(
+                        f"Saving sample from device {segment.device_id}, "
+                        f"label {self._label}, sample size {len(data)}"
+                    )
+                    new_samples.append(
+                        dict(
+                            label=self._label,
+                            data=data,
+                            format=segment.format,
+                            device_id=segment.device_id,
+                            recorded_at=segment.recorded_at,
+                            **db.get_sample_metadata(data, segment.format),
+                        )
+                    )
+                continue
+            if data:
+                self._write_chunk(segment, data)
+            if finished:
+                db.engine.execute(
+                    db.samples.update()
+                    .where(db.samples.c.id == segment.sample_id)
+                    .values(complete=True, **segment.get_metadata())
+                )
+                click.echo(
+                    f"Saved sample {segment.sample_id} from device {segment.device_id}, "
+                    f"label {self._label}, {segment.n_chunks} chunks"
+                )
+        if new_samples:
+            db.engine.execute(sa.insert(db.samples), new_samples)
+
+    def _write_chunk(self, segment, data):
+        if segment.sample_id is None:
+            result = db.engine.execute(
+                sa.insert(db.samples).values(
+                    label=self._label,
+                    data=b"",
+                    format=segment.format,
+                    complete=False,
+                    device_id=segment.device_id,
+                    recorded_at=segment.recorded_at,
+                )
+            )
+            segment.sample_id = result.inserted_primary_key[0]
+        db.engine.execute(
+            sa.insert(db.sample_chunks).values(
+                sample_id=segment.sample_id, seq=segment.n_chunks, data=data
+            )
+        )
+        segment.n_chunks += 1
+        segment.update_metadata(data)
+
+
+class Recorder:
+    """Split the audio received from devices into segments and save them
+
+    The devices send an empty payload when the audio drops below their
+    threshold, which ends the current segment of the device.
+    """
+
+    def __init__(self, label):
+        self._writer = SampleWriter(label)
+        self._segments = {}
+
+    def start(self):
+        self._writer.start()
+
+    def stop(self):
+        for device_id in list(self._segments):
+            self.finish(device_id)
+        self._writer.stop()
+
+    def record(self, device_id, payload, format):
+        if not payload:
+            self.finish(device_id)
+            return
+        segment = self._segments.get(device_id)
+        if segment is not None and segment.format != format:
+            self.finish(device_id)
+            segment = None
+        if segment is None:
+            segment = self._segments[device_id] = Segment(device_id, format)
+        segment.data += payload
+        if len(segment.data) >= CHUNK_SIZE:
+            self._writer.write_chunk(segment, segment.data)
+            segment.data = bytearray()
+
+    def finish(self, device_id):
+        segment = self._segments.pop(device_id, None)
+        if segment:
+            self._writer.finish(segment, segment.data)
@@ -0,0 +1,44 @@
+import time
+
+import click
+
+from . import db
+
+
+def list_samples(*, labels, device_ids, min_duration, limit):
+    """List the metadata of the samples"""
+    query = db.select_samples(
+        labels=labels, device_ids=device_ids, min_duration=min_duration
+    )
+    if limit:
+        query = query.limit(limit)
+    for id, label, format, device_id, recorded_at, duration, rms in db.engine.execute(
+        query
+    ):
+        click.echo(
+            f"{id:>8}  {label:<16}{format:<16}{device_id or '-':<16}"
+            f"{'-' if recorded_at is None else f'{recorded_at:%Y-%m-%d %H:%M:%S}':<21}"
+            f"{'-' if duration is None else f'{duration:.1f} s':>10}"
+            f"{'-' if rms is None else f'{rms:.0f}':>8}"
+        )
+
+
+def show_stats():
+    """Show the number and the total duration of the samples by label"""
+    start_time = time.perf_counter()
+    stats = db.get_sample_stats()
+    query_time = time.perf_counter() - start_time
+    for label, count, duration, rms, n_missing in stats:
+        click.echo(
+            f"{label:<16}{count:>8} samples{(duration or 0) / 60:>10.1f} min"
+            + ("" if rms is None else f"  mean RMS {rms:.0f}")
+            + (f"  ({n_missing} without metadata)" if n_missing else "")
+        )
+    click.echo(f"Queried in {1000 * query_time:.1f} ms")
+
+
+def migrate():
+    """Update the database schema, and compute the metadata of old samples"""
+    db.migrate_schema()
+    n_updated = db.backfill_metadata()
+    click.echo(f"Computed metadata for {n_updated} samples")
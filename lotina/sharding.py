@@ -0,0 +1,98 @@
+import multiprocessing
+import time
+import zlib
+
+import click
+
+RESTART_DELAY_S = 1.0
+MAX_RESTART_DELAY_S = 60.0
+STABLE_RUN_TIME_S = 60.0
+SUPERVISION_INTERVAL_S = 1.0
+SHUTDOWN_TIMEOUT_S = 30.0
+
+
+def get_shard(device_id, n_shards):
+    """Return the shard handling the device
+
+    The hash is stable across processes and restarts (unlike hash() of a
+    string), so a device always ends up in the same worker.
+    """
+    return zlib.crc32(device_id.encode()) % n_shards
+
+
+class Worker:
+    def __init__(self, context, target, args, kwargs, index):
+        self._context = context
+        self._target = target
+        self._args = args
+        self._kwargs = kwargs
+        self.index = index
+        self.process = None
+        self.started_at = None
+        self.restart_delay = RESTART_DELAY_S
+        self.restart_at = None
+
+    def start(self):
+        self.process = self._context.Process(
+            target=self._target,
+            args=self._args,
+            kwargs=self._kwargs,
+            name=f"lotina-shard-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.restart_at = None
+
+
+def run_sharded(process, n_shards, *args, **kwargs):
+    """Run the processor in worker processes, and restart the ones that die
+
+    Every worker subscribes to all devices, and drops the messages of the
+    devices of other shards, so that each device is processed by exactly one
+    worker. Workers dying soon after starting are restarted with exponential
+    backoff. On Ctrl-C, the workers (which get the interrupt too) are given
+    time to stop cleanly, e.g. to save the recordings in progress.
+    """
+    # TensorFlow isn't safe to fork, so the workers start from scratch
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        Worker(context, process, args, dict(kwargs, shard=(index, n_shards)), index)
+        for index in range(n_shards)
+    ]
+    for worker in workers:
+        worker.start()
+    click.echo(f"Started {n_shards} workers")
+
+    try:
+        while True:
+            time.sleep(SUPERVISION_INTERVAL_S)
+            now = time.monotonic()
+            for worker in workers:
+                if worker.restart_at is not None:
+                    if now >= worker.restart_at:
+                        click.echo(f"Restarting worker {worker.index}")
+                        worker.start()
+                elif not worker.process.is_alive():
+                    if now - worker.started_at >= STABLE_RUN_TIME_S:
+                        worker.restart_delay = RESTART_DELAY_S
+                    click.echo(
+                        f"Worker {worker.index} exited with code "
+                        f"{worker.process.exitcode}",
+                        err=True,
+                    )
+                    worker.restart_at = now + worker.restart_delay
+                    worker.restart_delay = min(
+                        2 * worker.restart_delay, MAX_RESTART_DELAY_S
+                    )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT_S
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+        for worker in workers:
+            if worker.process.is_alive():
+                click.echo(f"Terminating worker {worker.index}", err=True)
+                worker.process.terminate()
+                worker.process.join()
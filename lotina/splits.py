@@ -0,0 +1,49 @@
+import collections
+import json
+import random
+
+from .featurecache import get_cache_dir
+
+SPLIT_FRACTIONS = {"train": 0.6, "validation": 0.2, "test": 0.2}
+SPLIT_SEED = 0
+
+
+def assign_splits(rows, *, fractions=SPLIT_FRACTIONS, seed=SPLIT_SEED, path=None):
+    """Assign samples to the train, validation and test splits
+
+    The assignment is done once per sample and persisted, so that samples never
+    move from one split to another between training runs. New samples are
+    assigned in random (but deterministic) order to the split lagging furthest
+    behind its share of the samples with the same label.
+
+    Returns a dict mapping each split to its list of (id, label) rows.
+    """
+    path = path or get_cache_dir() / "splits.json"
+    assignments = json.loads(path.read_text()) if path.exists() else {}
+    assignments = {int(id): split for id, split in assignments.items()}
+
+    rows_by_label = collections.defaultdict(list)
+    for id, label in rows:
+        rows_by_label[label].append(id)
+
+    rng = random.Random(seed)
+    for label, ids in sorted(rows_by_label.items()):
+        counts = collections.Counter(assignments[id] for id in ids if id in assignments)
+        new_ids = sorted(id for id in ids if id not in assignments)
+        rng.shuffle(new_ids)
+        for id in new_ids:
+            split = max(
+                fractions, key=lambda split: fractions[split] * len(ids) - counts[split]
+            )
+            assignments[id] = split
+            counts[split] += 1
+
+    ids = {id for id, _ in rows}
+    assignments = {id: split for id, split in assignments.items() if id in ids}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(assignments, sort_keys=True))
+
+    splits = {split: [] for split in fractions}
+    for id, label in rows:
+        splits[assignments[id]].append((id, label))
+    return splits
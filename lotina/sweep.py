@@ -0,0 +1,243 @@
+import itertools
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from .model import BAND_FRAME_LENGTH, FEATURES_BANDS, FEATURES_SPECTROGRAM
+
+N_LATENCY_RUNS = 200
+SWEEP_PARAMETERS = [
+    "conv_filters",
+    "dense_units",
+    "sequence_length",
+    "n_segments",
+    "learning_rate",
+]
+
+
+def make_trials(grid, n_random=None, *, seed=0):
+    """Return the parameter combinations of the grid
+
+    If the number of random trials is given, that many combinations are
+    sampled from the grid instead of trying all of them.
+    """
+    trials = [
+        dict(zip(SWEEP_PARAMETERS, values))
+        for values in itertools.product(*(grid[name] for name in SWEEP_PARAMETERS))
+    ]
+    if n_random is not None and n_random < len(trials):
+        trials = random.Random(seed).sample(trials, n_random)
+    return trials
+
+
+def _get_window_shape(features, n_segments):
+    from .model import get_input_shape
+    from .processor import N_SAMPLES_FOR_PREDICTION, SAMPLES_PER_PAYLOAD
+
+    hop_length = BAND_FRAME_LENGTH if features == FEATURES_BANDS else n_segments // 2
+    n_frames = N_SAMPLES_FOR_PREDICTION * SAMPLES_PER_PAYLOAD // hop_length
+    return n_frames, get_input_shape(features, n_segments)[1]
+
+
+def _measure_latency(path, window_shape, n_threads):
+    from .inference import TFLiteModel, predict_batch
+
+    model = TFLiteModel(path, max_batch_size=1, n_threads=n_threads)
+    windows = np.random.default_rng(0).random((1, *window_shape), dtype=np.float32)
+    predict_batch(model, windows)
+    call_times = []
+    for _ in range(N_LATENCY_RUNS):
+        start_time = time.perf_counter()
+        predict_batch(model, windows)
+        call_times.append(time.perf_counter() - start_time)
+    return float(np.median(call_times)), float(np.percentile(call_times, 99))
+
+
+def run_trial(trial, splits, *, features, epochs, patience, n_threads, model_dir):
+    """Train and evaluate one combination of parameters in a fresh process
+
+    The features must already be in the cache. The TensorFlow Lite model is
+    exported to the model directory. Returns the parameters of the trial
+    together with the test accuracy, and the path and size of the model.
+    """
+    import tensorflow as tf
+
+    # The thread pools can only be configured before TensorFlow runs anything,
+    # which is why every trial gets its own process
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+
+    from .featurecache import FeatureCache
+    from .modeltraining import export_tflite, make_dataset, train_model
+
+    cache = FeatureCache(features=features, n_segments=trial["n_segments"], prune=False)
+    dataset_options = dict(
+        features=features,
+        sequence_length=trial["sequence_length"],
+        n_segments=trial["n_segments"],
+    )
+    train_dataset = make_dataset(cache, splits["train"], **dataset_options)
+    start_time = time.perf_counter()
+    model, history = train_model(
+        train_dataset,
+        make_dataset(cache, splits["validation"], shuffle=False, **dataset_options),
+        epochs=epochs,
+        features=features,
+        patience=patience,
+        learning_rate=trial["learning_rate"],
+        verbose=0,
+        n_segments=trial["n_segments"],
+        conv_filters=trial["conv_filters"],
+        dense_units=trial["dense_units"],
+    )
+    training_time = time.perf_counter() - start_time
+    test_results = model.evaluate(
+        make_dataset(cache, splits["test"], shuffle=False, **dataset_options),
+        return_dict=True,
+        verbose=0,
+    )
+
+    fd, path = tempfile.mkstemp(suffix=".tflite", dir=model_dir)
+    os.close(fd)
+    export_tflite(model, train_dataset, path, quantize=False)
+
+    return dict(
+        trial,
+        conv_filters=",".join(map(str, trial["conv_filters"])),
+        dense_units=",".join(map(str, trial["dense_units"])),
+        accuracy=test_results["binary_accuracy"],
+        loss=test_results["loss"],
+        epochs=len(history.history["loss"]),
+        training_time_s=training_time,
+        n_parameters=model.count_params(),
+        model_size_bytes=os.path.getsize(path),
+        model_path=path,
+    )
+
+
+def _describe_trial(result):
+    return ", ".join(f"{name}={result[name]}" for name in SWEEP_PARAMETERS)
+
+
+def _write_results(results, output):
+    pd.DataFrame(results).drop(columns="model_path", errors="ignore").to_csv(
+        output, index=False
+    )
+
+
+def _run_trial(arguments):
+    trial, splits, options = arguments
+    try:
+        return run_trial(trial, splits, **options)
+    except Exception as e:
+        # A diverging or too large combination shouldn't end the whole sweep
+        click.echo(f"Trial {trial} failed: {e}", err=True)
+        return None
+
+
+def sweep(
+    grid,
+    *,
+    n_random=None,
+    seed=0,
+    features=FEATURES_SPECTROGRAM,
+    epochs,
+    patience,
+    n_processes,
+    n_threads,
+    latency_threads=1,
+    min_accuracy,
+    output,
+):
+    """Train the parameter combinations in parallel, and report the results
+
+    The features are computed into the cache up front for each number of
+    segments, and shared by the trials. Each trial runs in its own process
+    with the given number of TensorFlow threads. The latency of the models is
+    measured one at a time once all of them are trained, with the given number
+    of interpreter threads, so that the trials still training don't slow the
+    measurement down. The results are written to a CSV file as they complete,
+    and the fastest model meeting the accuracy bar is reported at the end.
+    """
+    from .modeltraining import load_dataset_for_training
+
+    if features == FEATURES_BANDS:
+        # The band features don't depend on the number of segments
+        grid = dict(grid, n_segments=grid["n_segments"][:1])
+    trials = make_trials(grid, n_random, seed=seed)
+    # The splits don't depend on the parameters of the features either
+    for n_segments in sorted({trial["n_segments"] for trial in trials}):
+        _, splits = load_dataset_for_training(
+            features, n_segments=n_segments, prune=False
+        )
+
+    click.echo(
+        f"Running {len(trials)} trials in {n_processes} processes with "
+        f"{n_threads} threads each"
+    )
+    results = []
+    n_completed = 0
+    with tempfile.TemporaryDirectory() as model_dir:
+        options = dict(
+            features=features,
+            epochs=epochs,
+            patience=patience,
+            n_threads=n_threads,
+            model_dir=model_dir,
+        )
+        # TensorFlow isn't safe to fork, and each trial needs a fresh process to
+        # apply the thread limits
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(n_processes, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(
+                _run_trial, [(trial, splits, options) for trial in trials]
+            ):
+                n_completed += 1
+                if result is None:
+                    continue
+                results.append(result)
+                click.echo(
+                    f"[{n_completed}/{len(trials)}] {_describe_trial(result)}: "
+                    f"accuracy {result['accuracy']:.3f}, "
+                    f"size {result['model_size_bytes']} bytes"
+                )
+                _write_results(results, output)
+
+        click.echo(
+            f"Measuring the latency of {len(results)} models with "
+            f"{latency_threads} threads"
+        )
+        for result in results:
+            latency_p50, latency_p99 = _measure_latency(
+                result.pop("model_path"),
+                _get_window_shape(features, result["n_segments"]),
+                latency_threads,
+            )
+            result.update(
+                latency_p50_ms=1000 * latency_p50, latency_p99_ms=1000 * latency_p99
+            )
+            click.echo(
+                f"{_describe_trial(result)}: latency {result['latency_p50_ms']:.3f} ms"
+            )
+            _write_results(results, output)
+
+    if not results:
+        click.echo("All trials failed", err=True)
+        return
+    results = pd.DataFrame(results).sort_values("latency_p50_ms")
+    click.echo(results.to_string(index=False))
+    click.echo(f"Results written to {output}")
+    eligible = results[results["accuracy"] >= min_accuracy]
+    if eligible.empty:
+        click.echo(f"No trial reached accuracy {min_accuracy}")
+    else:
+        best = eligible.iloc[0]
+        click.echo(
+            f"Fastest trial with accuracy >= {min_accuracy}: " + _describe_trial(best)
+        )
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import click
+
+STATE_IDLE = "idle"
+STATE_WASHING = "washing"
+STATE_SOAP = "soap"
+STATE_COOLDOWN = "cooldown"
+
+EMA_ALPHA = 0.5
+ON_THRESHOLD = 127
+OFF_THRESHOLD = 96
+WASHING_TIMEOUT_S = 3
+COOLDOWN_TIMEOUT_S = 20
+CHECK_INTERVAL_S = 0.5
+
+
+def get_detection_topic(device_id):
+    return f"lotina/{device_id}/detection"
+
+
+class DeviceDetection:
+    def __init__(self, now):
+        self.state = STATE_IDLE
+        self.score = 0.0
+        self.since = now
+
+
+class DetectionTracker:
+    """Run the hand washing state machine of the devices on the server
+
+    The predictions of each device are smoothed with an exponential moving
+    average. Hand washing is detected when the average rises above the upper
+    threshold, and considered over when it falls below the lower one. The
+    timeouts are the same as on the device. Only the state changes are
+    published, instead of a prediction per message.
+    """
+
+    def __init__(
+        self,
+        publish,
+        *,
+        metrics,
+        alpha=EMA_ALPHA,
+        on_threshold=ON_THRESHOLD,
+        off_threshold=OFF_THRESHOLD,
+    ):
+        self._publish = publish
+        self._metrics = metrics
+        self._alpha = alpha
+        self._on_threshold = on_threshold
+        self._off_threshold = off_threshold
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def update(self, topic, prediction):
+        """Update the state of the device with a prediction
+
+        This has the same signature as the publish function of the
+        BatchScheduler, so that it can be used in place of it.
+        """
+        device_id = topic.split("/")[1]
+        now = time.monotonic()
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is None:
+                device = self._devices[device_id] = DeviceDetection(now)
+            device.score += self._alpha * (prediction - device.score)
+            self._transit(device_id, device, now)
+
+    def interrupt(self, device_id):
+        """Handle the device stopping to send audio, meaning there is no tap"""
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is not None:
+                device.score = 0.0
+                self._transit(device_id, device, time.monotonic())
+
+    def forget(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+    def _transit(self, device_id, device, now):
+        state = device.state
+        elapsed = now - device.since
+        if state == STATE_IDLE:
+            if device.score > self._on_threshold:
+                state = STATE_WASHING
+        elif state == STATE_WASHING:
+            if device.score < self._off_threshold:
+                state = STATE_IDLE
+            elif elapsed >= WASHING_TIMEOUT_S:
+                state = STATE_SOAP
+        elif state == STATE_SOAP:
+            if device.score < self._off_threshold:
+                state = STATE_COOLDOWN
+        elif state == STATE_COOLDOWN:
+            if elapsed >= COOLDOWN_TIMEOUT_S:
+                state = STATE_IDLE
+        if state != device.state:
+            click.echo(f"Device {device_id} state: {state}")
+            device.state = state
+            device.since = now
+            self._metrics.increment("state_changes")
+            self._publish(get_detection_topic(device_id), state)
+
+    def _run(self):
+        # The timeouts need to expire even if the device has gone silent
+        while not self._stopped.wait(CHECK_INTERVAL_S):
+            now = time.monotonic()
+            with self._lock:
+                for device_id, device in list(self._devices.items()):
+                    self._transit(device_id, device, now)
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import numpy as np
+
+from lotina.aioprocessor import AsyncProcessor, DeviceQueue
+from lotina.processor import SAMPLES_PER_PAYLOAD, Processor
+
+TOPIC = "lotina/device/samples"
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.windows = []
+
+    def submit(self, topic, window, timestamp):
+        self.windows.append(window.copy())
+
+
+def make_payloads(n_payloads):
+    samples = np.random.default_rng(0).integers(
+        -3000, 3000, n_payloads * SAMPLES_PER_PAYLOAD, dtype=np.int16
+    )
+    return [payload.tobytes() for payload in np.split(samples, n_payloads)]
+
+
+async def drain(async_processor):
+    while async_processor._queues:
+        await asyncio.sleep(0.01)
+
+
+def test_dropped_message_restarts_stream():
+    processor = Processor(None, False)
+    scheduler = processor._scheduler = FakeScheduler()
+    async_processor = AsyncProcessor(
+        processor, queue_size=2, max_message_age=60, n_workers=1
+    )
+    payloads = make_payloads(6)
+
+    async def run():
+        async_processor._loop = asyncio.get_running_loop()
+        for payload in payloads[:3]:
+            async_processor._enqueue(TOPIC, payload, time.monotonic())
+            await drain(async_processor)
+        # The queue holds two messages, so the first of these is dropped
+        for payload in payloads[3:]:
+            async_processor._enqueue(TOPIC, payload, time.monotonic())
+        await drain(async_processor)
+
+    asyncio.run(run())
+    # Only the window of the first three payloads is complete. The two
+    # payloads after the dropped one don't fill a window on their own.
+    assert len(scheduler.windows) == 1
+    assert not processor._devices["device"].frames.is_full()
+
+
+def test_queue_keeps_interrupts():
+    queue = DeviceQueue(2)
+    queue.put((None, None, b"", 0))
+    queue.put((None, None, b"audio", 1))
+    assert queue.put((None, None, b"audio", 2))
+    assert queue.gap
+    assert [timestamp for _, _, _, timestamp in queue.messages] == [0, 2]
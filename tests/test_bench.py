@@ -0,0 +1,31 @@
+import wave
+
+import click
+import pytest
+
+from lotina.bench import load_replay_audio
+from lotina.model import SAMPLING_FREQ
+
+
+def write_wav(path, *, sample_width=2, n_channels=1, frame_rate=SAMPLING_FREQ):
+    with wave.open(str(path), "wb") as f:
+        f.setsampwidth(sample_width)
+        f.setnchannels(n_channels)
+        f.setframerate(frame_rate)
+        f.writeframes(bytes(100 * sample_width * n_channels))
+
+
+def test_load_replay_audio_wav(tmp_path):
+    path = tmp_path / "fixture.wav"
+    write_wav(path)
+    assert load_replay_audio((), str(path)) == bytes(200)
+
+
+@pytest.mark.parametrize(
+    "options", [dict(sample_width=1), dict(n_channels=2), dict(frame_rate=44100)]
+)
+def test_load_replay_audio_rejects_other_wav_formats(tmp_path, options):
+    path = tmp_path / "fixture.wav"
+    write_wav(path, **options)
+    with pytest.raises(click.BadParameter):
+        load_replay_audio((), str(path))
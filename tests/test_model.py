@@ -0,0 +1,17 @@
+import pytest
+
+from lotina.model import SAMPLING_FREQ, parse_format
+
+
+def test_parse_format():
+    assert parse_format(f"pcm16/{SAMPLING_FREQ}") == ("pcm16", 1)
+    assert parse_format(f"mulaw/{SAMPLING_FREQ // 2}") == ("mulaw", 2)
+
+
+@pytest.mark.parametrize(
+    "format",
+    ["pcm16/0", f"pcm16/-{SAMPLING_FREQ}", "pcm16/", "pcm16/abc", "pcm16/44100", "aac"],
+)
+def test_parse_format_rejects_unsupported(format):
+    with pytest.raises(ValueError):
+        parse_format(format)
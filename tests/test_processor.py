@@ -0,0 +1,23 @@
+import pytest
+
+from lotina.model import DEFAULT_FORMAT, SAMPLING_FREQ
+from lotina.processor import Processor
+
+TOPIC = "lotina/device/format"
+
+
+@pytest.mark.parametrize(
+    "payload", [b"pcm16/0", f"pcm16/-{SAMPLING_FREQ}".encode(), b"\xff\xfe", b"aac"]
+)
+def test_set_format_ignores_invalid_format(payload):
+    processor = Processor(None, False)
+    processor.set_format(TOPIC, payload)
+    assert "device" not in processor._formats
+
+
+def test_set_format():
+    processor = Processor(None, False)
+    processor.set_format(TOPIC, f"mulaw/{SAMPLING_FREQ}".encode())
+    assert processor._formats["device"] == f"mulaw/{SAMPLING_FREQ}"
+    processor.set_format(TOPIC, b"")
+    assert processor._formats["device"] == DEFAULT_FORMAT